@@ -8,20 +8,18 @@ Once identified, script uses the Sierra API to check the item in again and clear
 
 # run in simian
 
-from sierra_ils_utils import SierraAPI
 import json
-import configparser
-import psycopg2
+import settings
+import sierra_db
 import os
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
-import gspread
 
 
 # function initializes a session using the Sierra API
 def init_api():
-    config = configparser.ConfigParser()
-    config.read("config.ini")
+    # imported here so runs with nothing to correct never load the API client
+    from sierra_ils_utils import SierraAPI
+
+    config = settings.load()
     """
     .ini file contains url/key/secret for the api in the following form
     [api]
@@ -44,22 +42,8 @@ def init_api():
 
 # function takes a sql query as a parameter, connects to a database and returns the results
 def runquery(query):
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    try:
-        conn = psycopg2.connect(config["sql"]["connection_string"])
-    except psycopg2.Error as e:
-        print("Unable to connect to database: " + str(e))
-
-    # Opening a session and querying the database
-    cursor = conn.cursor()
-    cursor.execute(query)
-    # Storing the results in a variable. We'll use it later.
-    rows = cursor.fetchall()
-    # close database connection
-    conn.close()
-    # return variable containing query results
+    # run on a connection from the shared Sierra pool rather than opening a new one
+    rows, columns = sierra_db.run_query(query, "sql")
     return rows
 
 
@@ -79,6 +63,10 @@ def checkin_item(barcode, username, statgroup, sierra_api):
 
 # log items that were corrected to an existing Google Sheet
 def appendToSheet(spreadSheetId, data):
+    # imported here as the Google client libraries are slow to load and most runs find nothing to log
+    from oauth2client.service_account import ServiceAccountCredentials
+    from googleapiclient.discovery import build
+
     scopes = [
         "https://spreadsheets.google.com/feeds",
         "https://www.googleapis.com/auth/drive",
@@ -144,9 +132,12 @@ def main():
             """
 
     item_errors = runquery(error_query)
+    # most runs find no errors, so stop before loading the Google and Sierra API clients
+    if not item_errors:
+        return
+
     # log query results to preexisting Google sheet
-    config = configparser.ConfigParser()
-    config.read("config.ini")
+    config = settings.load()
     appendToSheet(config["gsheet"]["correct_checkins"], item_errors)
 
     # initialize Sierra API
@@ -8,51 +8,27 @@ Minuteman Library Network
 Generate and send email notification to patrons with soon to expire library cards
 """
 
-import psycopg2
-import smtplib
-import configparser
+import sierra_db
+import smtp_delivery
+import mail_spool
+import queue
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import formatdate
 from email import encoders
-from datetime import date
+from datetime import date, timedelta
 
 
 def run_query(query):
-    # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    # Connecting to Sierra PostgreSQL database
-    try:
-        conn = psycopg2.connect(config["sql"]["connection_string"])
-    except psycopg2.Error as e:
-        print("Unable to connect to database: " + str(e))
-
-    # Opening a session and querying the database
-    cursor = conn.cursor()
-    cursor.execute(query)
-    # For now, just storing the data in a variable. We'll use it later.
-    rows = cursor.fetchall()
-    conn.close()
+    # run on a connection from the shared Sierra pool rather than opening a new one
+    rows, columns = sierra_db.run_query(query, "sql")
     return rows
 
 
-# function constructs and sends outgoing email given a subject, a recipient and body text in both txt and html forms
-def send_email(subject, message_text, message_html, recipient):
-    # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    # These are variables for the email that will be sent.
-    # Make sure to use your own library's email server (emailhost)
-    emailhost = config["email"]["host"]
-    emailuser = config["email"]["user"]
-    emailpass = config["email"]["pw"]
-    emailport = config["email"]["port"]
-    emailfrom = config["email"]["sender"]
-
+# function constructs an outgoing email given a subject, a recipient and body text in both txt and html forms
+def build_email(subject, message_text, message_html, recipient, emailfrom):
     # Creating the email message with html and plaintxt options
     msg = MIMEMultipart("alternative")
     part1 = MIMEText(message_text, "plain")
@@ -67,53 +43,25 @@ def send_email(subject, message_text, message_html, recipient):
     msg.attach(part1)
     msg.attach(part2)
 
-    # Sending the email message
-    smtp = smtplib.SMTP(emailhost, emailport)
-    # for Gmail connection used within Minuteman
-    smtp.ehlo()
-    smtp.starttls()
-    smtp.login(emailuser, emailpass)
-    smtp.sendmail(emailfrom, recipient, msg.as_string())
-    smtp.quit()
-
-
-def main():
-    query = """
-      --Find patrons in the first quarter of MLN libraries whose cards will expire in 30 days
-      SELECT
-        MIN(n.first_name),
-        MIN(n.last_name),
-        MIN(v.field_content) as email,
-        TO_CHAR(p.expiration_date_gmt,'Mon DD, YYYY'),
-        p.id
-      FROM sierra_view.patron_record as p
-      JOIN sierra_view.varfield v		
-        ON p.id = v.record_id
-        AND v.varfield_type_code = 'z'
-      JOIN sierra_view.patron_record_fullname n
-        ON p.id = n.patron_record_id
-      WHERE p.expiration_date_gmt::DATE = (CURRENT_DATE + INTERVAL '30 days')
-      AND p.ptype_code IN('1', '2', '3', '4', '5', '6', '7', '8', '10', '11', '12', '110', '301', '302', '303', '304', '305', '306', '307', '308', '310', '311', '312') 
-      GROUP BY 5, 4
-      """
-
-    query_results = run_query(query)
+    return msg
 
-    for rownum, row in enumerate(query_results):
 
-        # emailto can send to multiple addresses by separating emails with commas
-        emailto = [str(row[2])]
-        emailsubject = "It's time to renew your library card"
-        # Creating the email message
-        email_text = """Dear {} {},
+# render the expiration notice for a row of query results
+# returns the patron id, the recipients and the message, ready for smtp_delivery
+def render_notice(row, emailfrom):
+    # emailto can send to multiple addresses by separating emails with commas
+    emailto = [str(row[2])]
+    emailsubject = "It's time to renew your library card"
+    # Creating the email message
+    email_text = """Dear {} {},
        
 This is a reminder that your library card will expire on {}.  Renew your card online at https://www.minlib.net/erenew to continue your access to over 5 million items.
       
 ***This is an automated email***""".format(
-            str(row[0]), str(row[1]), str(row[3])
-        )
+        str(row[0]), str(row[1]), str(row[3])
+    )
 
-        email_html = """
+    email_html = """
     <html>
     <head></head>
     <body style="background-color:#FFFFFF;">
@@ -133,9 +81,103 @@ This is a reminder that your library card will expire on {}.  Renew your card on
     </table>
     </body>  
     </html>""".format(
-            str(row[0]), str(row[1]), str(row[3])
-        )
-        send_email(emailsubject, email_text, email_html, emailto)
+        str(row[0]), str(row[1]), str(row[3])
+    )
+
+    return row[4], emailto, build_email(emailsubject, email_text, email_html, emailto, emailfrom)
+
+
+# yield rows from a server side cursor, so the first rows can be used before the query has finished returning
+def stream_rows(query):
+    with sierra_db.stream_query(query, "sql") as (rows, columns):
+        yield from rows
+
+
+# run an iterable in a background thread, handing its items on through a bounded queue
+# each stage of the pipeline can then work on its next item while the following stage handles the last one
+def threaded(iterable, maxsize=500):
+    items = queue.Queue(maxsize)
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        yield item
+    # pass on any error from the stage, such as a lost database connection
+    if errors:
+        raise errors[0]
+
+
+# pipeline sets rows to flow from a server side cursor through rendering into the SMTP sessions,
+# rather than waiting for the whole query before rendering and sending anything
+def main(pipeline=False):
+    query = """
+      --Find patrons in the first quarter of MLN libraries whose cards will expire in 30 days
+      SELECT
+        MIN(n.first_name),
+        MIN(n.last_name),
+        MIN(v.field_content) as email,
+        TO_CHAR(p.expiration_date_gmt,'Mon DD, YYYY'),
+        p.id
+      FROM sierra_view.patron_record as p
+      JOIN sierra_view.varfield v		
+        ON p.id = v.record_id
+        AND v.varfield_type_code = 'z'
+      JOIN sierra_view.patron_record_fullname n
+        ON p.id = n.patron_record_id
+      WHERE p.expiration_date_gmt::DATE = (CURRENT_DATE + INTERVAL '30 days')
+      AND p.ptype_code IN('1', '2', '3', '4', '5', '6', '7', '8', '10', '11', '12', '110', '301', '302', '303', '304', '305', '306', '307', '308', '310', '311', '312') 
+      GROUP BY 5, 4
+      """
+
+    # each run's notice is for the cards expiring on one day, so a patron gets it once per expiration
+    notice = "card_expiring_{}".format(date.today() + timedelta(days=30))
+    spool = mail_spool.open_spool()
+    engine = smtp_delivery.DeliveryEngine()
 
+    if pipeline and not mail_spool.notice_complete(spool, notice):
+        # first send anything left unsent by earlier runs, such as a day whose run stopped partway
+        mail_spool.deliver_spool(spool, engine)
 
-main()
+        # fetching and rendering each run in their own thread, and each notice is sent as soon as it is spooled
+        rendered = threaded(
+            render_notice(row, engine.settings["sender"])
+            for row in threaded(stream_rows(query))
+        )
+        mail_spool.deliver_spool(
+            spool, engine, messages=mail_spool.spool_through(spool, notice, rendered)
+        )
+        mail_spool.mark_complete(spool, notice)
+    else:
+        # render every notice into the spool before sending any of them
+        # if today's notices were all spooled by a run that stopped partway, only send what is left
+        if not mail_spool.notice_complete(spool, notice):
+            query_results = run_query(query)
+            mail_spool.spool_messages(
+                spool,
+                notice,
+                (render_notice(row, engine.settings["sender"]) for row in query_results),
+            )
+            mail_spool.mark_complete(spool, notice)
+
+        # send every notice over a small pool of SMTP sessions rather than connecting once per patron
+        # this includes anything left unsent by earlier runs, not just today's notice
+        mail_spool.deliver_spool(spool, engine)
+
+    mail_spool.purge(spool)
+    spool.close()
+
+
+main(pipeline=True)
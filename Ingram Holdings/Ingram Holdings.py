@@ -10,123 +10,292 @@ Author: Jeremy Goldstein
 Contact Info: jgoldstein@minlib.net
 """
 
-import psycopg2
-import re
-import pymarc
-import configparser
 import os
-import pysftp
+import sys
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
+# shared modules such as sierra_db live in the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settings
+import sierra_db
+import sftp_uploads
+import ingram_delta
+import marc_encoder
 
-# function takes a sql query as a parameter, connects to a database and returns the results
-def run_query(query):
-    # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    # Connecting to Sierra PostgreSQL database
-    try:
-        conn = psycopg2.connect(config["sql"]["connection_string"])
-    except psycopg2.Error as e:
-        print("Unable to connect to database: " + str(e))
-
-    # Opening a session and querying the database
-    cursor = conn.cursor()
-    cursor.execute(query)
-    # For now, just storing the data in a variable. We'll use it later.
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
 
-
-# create file of MARC records based on data returned from run_query()
-def marc_writer(query_data, marc_file):
+# create file of MARC records based on holdings query results
+# records are encoded directly by marc_encoder, which writes the same bytes as pymarc
+# with more than one worker, chunks of records are encoded in parallel processes
+def marc_writer(query_data, marc_file, workers=1, chunk_rows=50000):
 
     # create a mrc file using the filename passed to the function
     os.makedirs(os.path.dirname(marc_file), exist_ok=True)
 
     # open file in write binary mode
     with open(marc_file, "wb") as f:
-        # iterate through each row of the file
-        for rownum, row in enumerate(query_data):
-
-            # declare PyMARC record object
-            item_load = pymarc.Record(to_unicode=True, force_utf8=True)
-
-            # define data fields in CSV file
-            ocn = row[1]
-            isbn = row[2].split("|")
-
-            # Clean up OCLC numbers with regular expression
-            ocn = re.sub("[^0-9]", "", ocn)
-
-            # write data to field variables
-            field_001 = pymarc.Field(tag="001", data=ocn)
-            item_load.add_ordered_field(field_001)
-            for i in isbn:
-                if i == "":
-                    break
-                field_020 = pymarc.Field(
-                    tag="020",
-                    indicators=pymarc.Indicators(" ", " "),
-                    subfields=[pymarc.Subfield(code="a", value=i)],
-                )
-                item_load.add_ordered_field(field_020)
-
-            # write date to file
-            f.write(item_load.as_marc())
+        if workers > 1:
+            marc_encoder.write_holdings_parallel(query_data, f, workers, chunk_rows)
+        else:
+            marc_encoder.write_holdings(query_data, f)
 
     return marc_file
 
 
-# function to sftp a specified file
-def sftp_file(file, library):
-    config = configparser.ConfigParser()
-    config.read("config.ini")
+# host, username and password for a library's Ingram account
+def ingram_login(library):
+    config = settings.load()
+    return (
+        config["ingram"]["host"],
+        config["ingram"]["user_" + library],
+        config["ingram"]["pw_" + library],
+    )
 
-    # set connection option to disable check for host key
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
 
-    # open sftp connection
-    srv = pysftp.Connection(
-        host=config["ingram"]["host"],
-        username=config["ingram"]["user_" + library],
-        password=config["ingram"]["pw_" + library],
-        cnopts=cnopts,
-    )
+# set up the sftp upload manager shared by every library, with upload_workers transfers at a time
+# if upload_dir is set in the [ingram] section, files are written there instead of being sent to Ingram
+def upload_manager():
+    config = settings.load()
+    connect = sftp_uploads.pysftp_connect
+    if config["ingram"].get("upload_dir"):
+        connect = functools.partial(sftp_uploads.LocalSFTP, config["ingram"]["upload_dir"])
+    return sftp_uploads.UploadManager(connect, config["ingram"].getint("upload_workers", 4))
+
+
+# function to sftp a specified file, reusing the library's connection from the upload manager
+def sftp_file(file, library, uploads):
     # upload specified file to root directory
-    srv.put(file)
+    uploads.upload(file, *ingram_login(library))
 
-    # close connection
-    srv.close()
 
+# query parameters for multi_ingram_holdings.sql covering the given libraries from ingram_libraries.ini
+# after_record_id limits the results to records after it, for resuming a streamed upload
+def library_params(libraries, codes, after_record_id=None):
+    return {
+        "after_record_id": after_record_id,
+        "codes": codes,
+        "location_regexes": [libraries[code]["location_regex"] for code in codes],
+        "accounting_units": [libraries[code].getint("accounting_unit") for code in codes],
+        "excluded_statuses": [libraries[code]["excluded_statuses"] for code in codes],
+        "order_statuses": [libraries[code]["order_statuses"] for code in codes],
+    }
 
-def main(library):
-    # run holdings query for specified library
-    query = open(library + "_ingram_holdings.sql", "r").read()
-    query_results = run_query(query)
+
+# run a single holdings query for every library in ingram_libraries.ini, or only the libraries in codes
+# returns a dictionary of query results in the same form as the per library queries, keyed by library
+def extract_holdings(libraries_file="ingram_libraries.ini", codes=None):
+    libraries = settings.load(libraries_file)
+    if codes is None:
+        codes = libraries.sections()
+
+    query = sierra_db.load_query("multi_ingram_holdings.sql")
+    query_results, headers = sierra_db.run_prepared(
+        query, library_params(libraries, codes), "sql"
+    )
+
+    # split rows up by the library column, dropping it so rows match the per library queries
+    holdings = {code: [] for code in codes}
+    for row in query_results:
+        holdings[row[0]].append(row[1:])
+    return holdings
+
+
+# stream a library's full holdings from a server side cursor through the MARC encoder straight into a file on Ingram's server
+# no local file is written and only one batch of rows and one block of records are held in memory at a time
+# blocks end on a record boundary and each is recorded in the snapshot once it is written, so if the upload fails
+# the file is cut back to the last complete block and the query resumes after that block's last record id
+# records go to a .part file that is only renamed to its final name once the whole extraction has passed
+# ingram_delta.check_shrink(), and the .part file is removed if the upload gives up
+def stream_holdings(library, store, uploads, libraries_file="ingram_libraries.ini", attempts=3, max_shrink=0.25):
+    # imported here so runs that do not stream never load paramiko, which is slow to import
+    import paramiko
+
+    libraries = settings.load(libraries_file)
+    query = sierra_db.load_query("multi_ingram_holdings.sql")
+    remote_file = library + "_holdings{}.mrc".format(date.today())
+    part_file = remote_file + ".part"
+
+    # bytes of the remote file holding complete records, and the last record id they include
+    sent, last_record_id = 0, None
+    previous_count = ingram_delta.snapshot_count(store, library)
+    ingram_delta.clear_snapshot(store, library)
+
+    try:
+        for attempt in range(1, attempts + 1):
+            try:
+                # a connection that failed is closed by the upload manager, so each attempt starts a fresh one
+                with uploads.session(*ingram_login(library)) as srv:
+                    start = time.perf_counter()
+                    resumed_from = sent
+                    if sent and srv.stat(part_file).st_size < sent:
+                        # records reported as written never reached the server, so start the file again
+                        sent, last_record_id, resumed_from = 0, None, 0
+                        ingram_delta.clear_snapshot(store, library)
+                    elif sent:
+                        # drop any partial block left by the failed attempt, along with its snapshot rows
+                        srv.truncate(part_file, sent)
+                        ingram_delta.clear_snapshot(store, library, last_record_id)
+
+                    params = library_params(libraries, [library], last_record_id)
+                    with sierra_db.stream_query(query, "sql", params=params) as (rows, columns):
+                        with srv.open(part_file, "r+b" if sent else "wb") as remote:
+                            remote.seek(sent)
+                            # drop the library column, leaving rows in the form of the per library queries
+                            blocks = marc_encoder.encode_holding_blocks(row[1:] for row in rows)
+                            for block_rows, data in blocks:
+                                remote.write(data)
+                                # make sure the block is on the server before counting it as sent
+                                remote.flush()
+                                ingram_delta.snapshot_batch(store, library, block_rows)
+                                sent += len(data)
+                                last_record_id = block_rows[-1][0]
+
+                    # the snapshot now holds every record streamed, across all attempts
+                    ingram_delta.check_shrink(
+                        library, ingram_delta.snapshot_count(store, library), previous_count, max_shrink
+                    )
+                    if srv.exists(remote_file):
+                        srv.remove(remote_file)
+                    srv.rename(part_file, remote_file)
+
+                elapsed = time.perf_counter() - start
+                sftp_uploads.report(
+                    {
+                        "file": remote_file,
+                        "host": ingram_login(library)[0],
+                        "bytes": sent - resumed_from,
+                        "seconds": elapsed,
+                        "bytes_per_second": (sent - resumed_from) / elapsed if elapsed else 0,
+                    }
+                )
+                return
+            except (OSError, EOFError, paramiko.SSHException) as e:
+                if attempt == attempts:
+                    raise
+                print("Upload of {} failed, resuming after record {}: {}".format(remote_file, last_record_id, e))
+    except BaseException:
+        # the upload, the Sierra query or the shrink check failed, so leave neither a snapshot nor a partial file behind
+        store.rollback()
+        try:
+            with uploads.session(*ingram_login(library)) as srv:
+                if srv.exists(part_file):
+                    srv.remove(part_file)
+        except (OSError, EOFError, paramiko.SSHException) as e:
+            print("Could not remove {}: {}".format(part_file, e))
+        raise
+
+
+# write query results to a marc file named for the library and label, sftp it to Ingram and delete it
+def send_holdings(query_data, library, uploads, label="holdings"):
+    config = settings.load()
 
     # generate marc file based on those query results
     marc_file_name = (
         "/Ingram Holdings/Temp_Files/"
         + library
-        + "_holdings{}.mrc".format(date.today())
+        + "_{}{}.mrc".format(label, date.today())
     )
-    marc_file = marc_writer(query_results, marc_file_name)
-
-    # sftp file to Ingram
-    sftp_file(
-        "C:\\Ingram Holdings\\Temp_Files\\"
-        + library
-        + "_holdings{}.mrc".format(date.today()),
-        library,
+    marc_file = marc_writer(
+        query_data,
+        marc_file_name,
+        config["ingram"].getint("marc_workers", 1),
+        config["ingram"].getint("marc_chunk_rows", 50000),
     )
 
+    # sftp the file that was just written to Ingram
+    sftp_file(marc_file, library, uploads)
+
     # delete file once script is complete
     os.remove(marc_file)
 
 
-main("blm")
-main("con")
+# a library's full_refresh_days and max_shrink settings from ingram_libraries.ini
+def delta_settings(library, libraries_file="ingram_libraries.ini"):
+    libraries = settings.load(libraries_file)
+    full_refresh_days, max_shrink = 30, 0.25
+    if library in libraries:
+        full_refresh_days = libraries[library].getint("full_refresh_days", full_refresh_days)
+        max_shrink = libraries[library].getfloat("max_shrink", max_shrink)
+    return full_refresh_days, max_shrink
+
+
+# check whether a library is due to be sent a full file rather than its changes
+def full_refresh_due(library, libraries_file="ingram_libraries.ini"):
+    store = ingram_delta.open_snapshots(library)
+    try:
+        return ingram_delta.full_refresh_due(store, library, delta_settings(library, libraries_file)[0])
+    finally:
+        store.close()
+
+
+# query_results can be passed in from extract_holdings(), otherwise multi_ingram_holdings.sql is run for just this library
+# only records added, changed or removed since the last upload are sent, with a full file every full_refresh_days
+# with stream set, full files are streamed straight from Sierra to Ingram by stream_holdings()
+def main(library, uploads, query_results=None, libraries_file="ingram_libraries.ini", stream=False):
+    full_refresh_days, max_shrink = delta_settings(library, libraries_file)
+
+    store = ingram_delta.open_snapshots(library)
+    if stream and ingram_delta.full_refresh_due(store, library, full_refresh_days):
+        stream_holdings(library, store, uploads, libraries_file, max_shrink=max_shrink)
+        ingram_delta.commit_snapshot(store, library, True)
+        store.close()
+        return
+
+    # run holdings query for specified library
+    if query_results is None:
+        query_results = extract_holdings(libraries_file, [library])[library]
+
+    # compare against the holdings sent last time
+    # raises rather than sending anything if the extraction is empty or much smaller than last time
+    mode, adds, deletes = ingram_delta.plan_delta(
+        store, library, query_results, full_refresh_days, max_shrink
+    )
+
+    if mode == "full":
+        send_holdings(query_results, library, uploads)
+    else:
+        if deletes:
+            send_holdings(deletes, library, uploads, "holdings_delete")
+        if adds:
+            send_holdings(adds, library, uploads, "holdings_add")
+
+    # only record what was sent once every upload has succeeded
+    ingram_delta.save_snapshot(store, library, query_results, mode == "full")
+    store.close()
+
+
+# worker processes used by marc_writer() import this script again on Windows, so only run from the command line
+if __name__ == "__main__":
+    config = settings.load()
+
+    # open the pooled Sierra connection once, then reuse it for each library
+    sierra_db.warm_up("sql")
+
+    # libraries are built and uploaded concurrently, with the upload manager limiting how many transfers run at once
+    with upload_manager() as uploads, ThreadPoolExecutor(
+        max_workers=uploads.max_workers
+    ) as executor:
+        if config["ingram"].getboolean("stream", False):
+            # full files are streamed one library at a time, so all of the holdings are never held in memory at once
+            # libraries that only send their changes today are extracted together in a single query
+            libraries = settings.load("ingram_libraries.ini")
+            delta_libraries = [
+                library for library in libraries.sections() if not full_refresh_due(library)
+            ]
+            holdings = extract_holdings(codes=delta_libraries) if delta_libraries else {}
+            futures = [
+                executor.submit(main, library, uploads, holdings.get(library), stream=True)
+                for library in libraries.sections()
+            ]
+        else:
+            # extract holdings for every library at once, then build and send each library's file
+            holdings = extract_holdings()
+            futures = [
+                executor.submit(main, library, uploads, query_results)
+                for library, query_results in holdings.items()
+            ]
+        # raise the first error from any library
+        for future in futures:
+            future.result()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""Check that marc_encoder writes the same bytes as pymarc and time both
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Sample holdings rows are generated rather than queried so the benchmark can run without
+a Sierra connection. The rows include OCLC prefixes, multiple ISBNs, empty ISBN lists and
+non-ASCII characters to cover each path through the encoder.
+
+The parallel encoder is timed with one worker per CPU.
+
+usage: python benchmark_marc_encoder.py [rows] [runs]
+"""
+
+import io
+import random
+import re
+import sys
+import time
+
+import pymarc
+
+import marc_encoder
+
+
+# the original marc_writer() loop, building a pymarc record for every row
+def pymarc_write(query_data, f):
+    for row in query_data:
+        item_load = pymarc.Record(to_unicode=True, force_utf8=True)
+
+        ocn = re.sub("[^0-9]", "", row[1])
+        isbn = row[2].split("|")
+
+        field_001 = pymarc.Field(tag="001", data=ocn)
+        item_load.add_ordered_field(field_001)
+        for i in isbn:
+            if i == "":
+                break
+            field_020 = pymarc.Field(
+                tag="020",
+                indicators=pymarc.Indicators(" ", " "),
+                subfields=[pymarc.Subfield(code="a", value=i)],
+            )
+            item_load.add_ordered_field(field_020)
+
+        f.write(item_load.as_marc())
+
+
+# generate rows in the (record_id, 001, 020) form returned by the holdings queries
+def sample_rows(count, seed=2026):
+    rng = random.Random(seed)
+    prefixes = ["ocm", "ocn", "on", "(OCoLC)", ""]
+    rows = []
+    for record_id in range(count):
+        ocn = rng.choice(prefixes) + str(rng.randint(1, 9999999999))
+        isbns = [
+            str(rng.randint(9780000000000, 9799999999999))
+            for i in range(rng.choice([0, 1, 1, 2, 3, 6]))
+        ]
+        if rng.random() < 0.01:
+            isbns.append("978é (pbk.)")
+        if rng.random() < 0.01:
+            isbns.insert(0, "")
+        rows.append((420000000000 + record_id, ocn, "|".join(isbns)))
+    return rows
+
+
+# run a writer several times, returning the fastest run in seconds with its output
+def best_of(writer, rows, runs):
+    best = None
+    for run in range(runs):
+        f = io.BytesIO()
+        start = time.perf_counter()
+        writer(rows, f)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, f.getvalue()
+
+
+def main(row_count=200000, runs=3):
+    rows = sample_rows(row_count)
+
+    pymarc_time, pymarc_output = best_of(pymarc_write, rows, runs)
+    encoder_time, encoder_output = best_of(marc_encoder.write_holdings, rows, runs)
+    parallel_time, parallel_output = best_of(
+        lambda rows, f: marc_encoder.write_holdings_parallel(rows, f, chunk_rows=10000),
+        rows,
+        runs,
+    )
+
+    print("pymarc: {} rows, {:.3f}s".format(row_count, pymarc_time))
+    print("marc_encoder: {} rows, {:.3f}s".format(row_count, encoder_time))
+    print("speedup: {:.1f}x".format(pymarc_time / encoder_time))
+    print("marc_encoder parallel: {} rows, {:.3f}s".format(row_count, parallel_time))
+    print("speedup: {:.1f}x".format(pymarc_time / parallel_time))
+
+    matches = True
+    for name, output in [("marc_encoder", encoder_output), ("marc_encoder parallel", parallel_output)]:
+        if output == pymarc_output:
+            print("{} output is byte identical ({} bytes)".format(name, len(output)))
+        else:
+            print("{} output differs".format(name))
+            matches = False
+    if not matches:
+        sys.exit(1)
+
+
+# worker processes import this script again on Windows, so only run from the command line
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
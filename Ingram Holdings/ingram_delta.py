@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""Track the holdings last sent to Ingram so only the changes need to be sent
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+A snapshot of the (bib id, 001, ISBN set) rows sent for each library, one for each 001 of a
+bib, is kept in a local SQLite file per library, so libraries can be sent concurrently. New extractions are compared against it to produce the records to add and the
+records to delete. Records whose 001 or ISBNs changed are deleted in their old form and
+added in their new form. Every full_refresh_days a full file is sent instead, so that any
+drift between the snapshot and Ingram's copy is corrected.
+"""
+
+import sqlite3
+from datetime import date, timedelta
+
+import marc_encoder
+
+
+# open the snapshot store, creating its tables on first use
+def open_snapshots(library):
+    store = sqlite3.connect("ingram_snapshot_{}.db".format(library))
+    store.execute(
+        "CREATE TABLE IF NOT EXISTS full_refresh (library TEXT PRIMARY KEY, sent_date TEXT)"
+    )
+    # snapshots keyed by record id alone lost all but one row of a bib with several 001s
+    # drop them, and the record of the last full file, so the next run sends a full file and records every row
+    key = [column[1] for column in store.execute("PRAGMA table_info(holding)") if column[5]]
+    if key and "ocn" not in key:
+        store.execute("DROP TABLE holding")
+        store.execute("DELETE FROM full_refresh")
+        store.commit()
+    store.execute(
+        """
+        CREATE TABLE IF NOT EXISTS holding (
+          library TEXT,
+          record_id INTEGER,
+          ocn TEXT,
+          isbns TEXT,
+          PRIMARY KEY (library, record_id, ocn)
+        )"""
+    )
+    return store
+
+
+# reduce a query row to the values that are sent to Ingram, cleaned the same way as marc_writer()
+def holding_values(row):
+    ocn, isbns = marc_encoder.holding_fields(row)
+    return ocn, "|".join(sorted(isbns))
+
+
+# check whether a library has never had a full file sent, or its last one is full_refresh_days old
+def full_refresh_due(store, library, full_refresh_days=30):
+    row = store.execute(
+        "SELECT sent_date FROM full_refresh WHERE library = ?", (library,)
+    ).fetchone()
+    return row is None or date.fromisoformat(row[0]) <= date.today() - timedelta(
+        days=full_refresh_days
+    )
+
+
+# number of records in a library's snapshot, including rows recorded but not yet committed
+def snapshot_count(store, library):
+    return store.execute(
+        "SELECT COUNT(DISTINCT record_id) FROM holding WHERE library = ?", (library,)
+    ).fetchone()[0]
+
+
+# refuse to send a library's holdings if the extraction is empty or has lost more than max_shrink of the
+# previous_count records in the snapshot, as that is far more likely to be a failed query than real weeding
+def check_shrink(library, record_count, previous_count, max_shrink=0.25):
+    if previous_count and (
+        record_count == 0 or record_count < previous_count * (1 - max_shrink)
+    ):
+        raise ValueError(
+            "Not sending {} holdings: {} records extracted, {} sent last time".format(
+                library, record_count, previous_count
+            )
+        )
+
+
+# compare a library's new extraction with its snapshot
+# returns "full" with every row when a full refresh is due, otherwise "delta" with the rows to add and delete
+# rows keep the (record_id, 001, 020) form of the holdings queries so marc_writer() can write either list
+def plan_delta(store, library, query_results, full_refresh_days=30, max_shrink=0.25):
+    check_shrink(
+        library,
+        len({row[0] for row in query_results}),
+        snapshot_count(store, library),
+        max_shrink,
+    )
+    if full_refresh_due(store, library, full_refresh_days):
+        return "full", list(query_results), []
+
+    # a bib with several 001s has a row, and a MARC record, for each, so rows are matched on record id and 001
+    previous = {
+        (record_id, ocn): isbns
+        for record_id, ocn, isbns in store.execute(
+            "SELECT record_id, ocn, isbns FROM holding WHERE library = ?", (library,)
+        )
+    }
+    current, adds = {}, []
+    for row in query_results:
+        ocn, isbns = holding_values(row)
+        current[(row[0], ocn)] = isbns
+        if previous.get((row[0], ocn)) != isbns:
+            adds.append(row)
+
+    deletes = [
+        (record_id, ocn, isbns)
+        for (record_id, ocn), isbns in previous.items()
+        if current.get((record_id, ocn)) != isbns
+    ]
+    return "delta", adds, deletes
+
+
+# remove a library's snapshot, or only the records after after_record_id, before new rows are recorded
+# nothing is committed, so the snapshot can be rolled back if the upload fails
+def clear_snapshot(store, library, after_record_id=None):
+    if after_record_id is None:
+        store.execute("DELETE FROM holding WHERE library = ?", (library,))
+    else:
+        store.execute(
+            "DELETE FROM holding WHERE library = ? AND record_id > ?",
+            (library, after_record_id),
+        )
+
+
+# record rows in a library's snapshot, without committing
+def snapshot_batch(store, library, rows):
+    store.executemany(
+        "INSERT OR REPLACE INTO holding VALUES (?, ?, ?, ?)",
+        [(library, row[0]) + holding_values(row) for row in rows],
+    )
+
+
+# pass rows through unchanged while replacing the library's snapshot with them, so rows can be recorded as they stream
+# nothing is committed, so the snapshot can be rolled back if the upload fails
+def snapshot_rows(store, library, rows, batch_size=1000):
+    clear_snapshot(store, library)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            snapshot_batch(store, library, batch)
+            batch = []
+        yield row
+    snapshot_batch(store, library, batch)
+
+
+# commit the snapshot, noting the date if a full file was sent, call only once the upload has succeeded
+def commit_snapshot(store, library, full_refresh):
+    if full_refresh:
+        store.execute(
+            "INSERT OR REPLACE INTO full_refresh VALUES (?, ?)",
+            (library, date.today().isoformat()),
+        )
+    store.commit()
+
+
+# replace a library's snapshot with what has just been sent, call only once the upload has succeeded
+def save_snapshot(store, library, query_results, full_refresh):
+    for row in snapshot_rows(store, library, query_results):
+        pass
+    commit_snapshot(store, library, full_refresh)
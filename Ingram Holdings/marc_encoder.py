@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""Encode the minimal MARC records sent to Ingram without building pymarc objects
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Holdings records only ever contain a 001 and any number of 020 $a fields, so the leader,
+directory and fields can be written straight into a bytes buffer. The output is byte for
+byte the same as building a pymarc.Record(to_unicode=True, force_utf8=True) and calling
+as_marc(), which benchmark_marc_encoder.py checks.
+
+write_holdings_parallel() splits the rows into chunks and encodes them in a pool of worker
+processes, writing the encoded chunks out in their original order. As worker processes
+re-import the main script on Windows, scripts using it must guard their top level code with
+if __name__ == "__main__".
+"""
+
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+LEADER = b"%05d    a22%05d   4500"
+END_OF_FIELD = b"\x1e"
+END_OF_RECORD = b"\x1d"
+ISBN_PREFIX = b"  \x1fa"
+NON_DIGITS = re.compile("[^0-9]")
+
+# the leader, plus the end of field marking the end of the directory
+LEADER_LEN = 25
+DIRECTORY_ENTRY_LEN = 12
+
+
+# clean a (record_id, 001, 020) query row into the 001 and the list of ISBNs that are written
+# as in the original pymarc writer, ISBNs stop at the first empty value
+def holding_fields(row):
+    ocn = NON_DIGITS.sub("", row[1])
+    isbns = row[2].split("|")
+    if "" in isbns:
+        isbns = isbns[: isbns.index("")]
+    return ocn, isbns
+
+
+# append the MARC record for a 001 and list of ISBNs to a bytearray
+def encode_holding(buffer, ocn, isbns):
+    ocn_data = ocn.encode("utf-8")
+    isbn_data = [isbn.encode("utf-8") for isbn in isbns]
+
+    ocn_length = len(ocn_data) + 1
+    base_address = LEADER_LEN + DIRECTORY_ENTRY_LEN * (1 + len(isbn_data))
+    record_length = base_address + ocn_length + 1
+    for isbn in isbn_data:
+        record_length += len(isbn) + 5
+
+    # leader and directory
+    buffer += LEADER % (record_length, base_address)
+    buffer += b"001%04d00000" % ocn_length
+    offset = ocn_length
+    for isbn in isbn_data:
+        buffer += b"020%04d%05d" % (len(isbn) + 5, offset)
+        offset += len(isbn) + 5
+    buffer += END_OF_FIELD
+
+    # fields
+    buffer += ocn_data
+    buffer += END_OF_FIELD
+    for isbn in isbn_data:
+        buffer += ISBN_PREFIX
+        buffer += isbn
+        buffer += END_OF_FIELD
+    buffer += END_OF_RECORD
+
+
+# encode (record_id, 001, 020) query rows as MARC, yielding the records in blocks of about flush_bytes
+# records are collected in one reusable buffer, so rows can be streamed through with bounded memory
+def encode_holdings(query_data, flush_bytes=1048576):
+    buffer = bytearray()
+    for row in query_data:
+        ocn, isbns = holding_fields(row)
+        encode_holding(buffer, ocn, isbns)
+        if len(buffer) >= flush_bytes:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+# encode (record_id, 001, 020) query rows as MARC in blocks of about flush_bytes that end on a record id boundary
+# yields each block's rows with its encoded bytes, so rows sharing a record id are never split between blocks
+def encode_holding_blocks(query_data, flush_bytes=1048576):
+    buffer = bytearray()
+    block = []
+    for row in query_data:
+        if block and len(buffer) >= flush_bytes and row[0] != block[-1][0]:
+            yield block, bytes(buffer)
+            buffer.clear()
+            block = []
+        ocn, isbns = holding_fields(row)
+        encode_holding(buffer, ocn, isbns)
+        block.append(row)
+    if block:
+        yield block, bytes(buffer)
+
+
+# write the MARC records for (record_id, 001, 020) query rows to a binary file object
+def write_holdings(query_data, f, flush_bytes=1048576):
+    for data in encode_holdings(query_data, flush_bytes):
+        f.write(data)
+
+
+# encode a list of query rows to bytes, run in a worker process by write_holdings_parallel()
+def encode_chunk(rows):
+    buffer = bytearray()
+    for row in rows:
+        ocn, isbns = holding_fields(row)
+        encode_holding(buffer, ocn, isbns)
+    return bytes(buffer)
+
+
+# split query rows into lists of chunk_rows rows
+def chunks(query_data, chunk_rows):
+    chunk = []
+    for row in query_data:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# write the MARC records for query rows to a binary file object, encoding chunks across worker processes
+# only a couple of chunks per worker are in flight at once, so memory stays bounded for large extracts
+def write_holdings_parallel(query_data, f, workers=None, chunk_rows=50000):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for chunk in chunks(query_data, chunk_rows):
+            in_flight.append(executor.submit(encode_chunk, chunk))
+            if len(in_flight) >= workers * 2:
+                f.write(in_flight.popleft().result())
+        while in_flight:
+            f.write(in_flight.popleft().result())
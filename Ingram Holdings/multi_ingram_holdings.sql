@@ -0,0 +1,100 @@
+--print items and orders for every library listed in ingram_libraries.ini in a single pass
+--the catalog wide not_multi_volume and isbn lookups are shared by all of the libraries
+--each row is tagged with the code of the library it is a holding for
+--rows are ordered by record id within each library so a streamed upload can resume where it stopped,
+--then by the remaining columns so a bib with several 001s always comes out in the same order
+--after_record_id skips the records already sent by an interrupted upload, pass NULL to include every record
+
+WITH libraries AS (
+  SELECT *
+  FROM UNNEST(
+    %(codes)s::VARCHAR[],
+    %(location_regexes)s::VARCHAR[],
+    %(accounting_units)s::INT[],
+    %(excluded_statuses)s::VARCHAR[],
+    %(order_statuses)s::VARCHAR[]
+  ) AS lib(code, location_regex, accounting_unit, excluded_statuses, order_statuses)
+),
+
+not_multi_volume AS (
+  SELECT l.bib_record_id
+  
+  FROM sierra_view.bib_record_item_record_link l
+  LEFT JOIN sierra_view.varfield v
+    ON l.item_record_id = v.record_id
+    AND v.varfield_type_code = 'v'
+    
+  GROUP BY 1
+  HAVING COUNT(l.item_record_id) FILTER(WHERE v.field_content IS NOT NULL) = 0
+),
+
+library_bibs AS (
+  SELECT
+    DISTINCT inner_query.code,
+    inner_query.bib_record_id
+  FROM (
+    SELECT
+      lib.code,
+      l.bib_record_id
+
+      FROM not_multi_volume nmv
+      JOIN sierra_view.bib_record_item_record_link l
+        ON nmv.bib_record_id = l.bib_record_id
+      JOIN sierra_view.item_record i
+        ON l.item_record_id = i.id
+      JOIN libraries lib
+        ON i.location_code ~ lib.location_regex
+        AND i.item_status_code <> ALL(STRING_TO_ARRAY(lib.excluded_statuses, ','))
+
+    UNION
+
+    SELECT
+      lib.code,
+      ol.bib_record_id
+    
+    FROM not_multi_volume nmv
+    JOIN sierra_view.bib_record_order_record_link ol
+      ON nmv.bib_record_id = ol.bib_record_id
+    JOIN sierra_view.order_record o
+      ON ol.order_record_id = o.id
+    JOIN libraries lib
+      ON o.accounting_unit_code_num = lib.accounting_unit
+      AND (lib.order_statuses = '' OR o.order_status_code = ANY(STRING_TO_ARRAY(lib.order_statuses, ',')))
+  )inner_query 
+),
+
+bibs AS (
+  SELECT DISTINCT bib_record_id
+  FROM library_bibs
+),
+
+isbn AS (
+SELECT
+  s.record_id,
+  COALESCE(STRING_AGG(DISTINCT SUBSTRING(s.content FROM '^\d{9,12}[\d|X]'),'|'),'') AS "isbns"
+  FROM bibs b
+  JOIN sierra_view.subfield s
+    ON b.bib_record_id = s.record_id
+	 AND s.marc_tag = '020'
+	 AND s.tag = 'a'
+  GROUP BY 1
+)
+
+SELECT
+  lb.code AS library,
+  i.record_id,
+  COALESCE(SUBSTRING(o.content FROM '[0-9]+'),'') AS "001",
+  i.isbns AS "020"
+
+FROM library_bibs lb
+JOIN isbn i
+  ON lb.bib_record_id = i.record_id
+JOIN sierra_view.bib_record_property b
+  ON i.record_id = b.bib_record_id 
+LEFT JOIN sierra_view.subfield o
+  ON i.record_id = o.record_id
+  AND o.marc_tag = '001'
+
+WHERE b.material_code IN ('2','f','9','a','e','o','p','t')
+  AND i.record_id > COALESCE(%(after_record_id)s::BIGINT, 0)
+ORDER BY 1, 2, 3, 4
@@ -0,0 +1,116 @@
+/* Weekly New Report, optimized
+Returns the same rows as WeeklyNewItemsRev.sql.
+The creation date is compared without a ::date cast so an index on it can be used,
+and series, orders and holds are each counted once per bib (or per item for item level holds)
+before being joined back to the new items, rather than joining them all together and
+collapsing the fan-out with count(distinct ...) and string_agg(distinct ...).
+ */
+
+WITH new_items AS (
+  SELECT
+    i.id AS item_id,
+    bri.bib_record_id,
+    i.location_code,
+    UPPER(peb.index_entry) AS call_number,
+    i.barcode,
+    i.item_status_code
+  FROM sierra_view.item_view i
+  JOIN sierra_view.bib_record_item_record_link bri
+    ON i.id = bri.item_record_id
+  JOIN sierra_view.phrase_entry peb
+    ON i.id = peb.record_id
+    AND peb.index_tag='c'
+  WHERE i.record_creation_date_gmt >= NOW()::DATE-EXTRACT(DOW FROM NOW())::INTEGER-10
+),
+
+item_groups AS (
+  SELECT
+    n.bib_record_id,
+    n.location_code,
+    n.call_number,
+    string_agg(distinct n.barcode, ' ') AS barcodes,
+    count(distinct n.item_id) FILTER(WHERE n.item_status_code not in ('m','n','z','t','s','$','d','8','w','y')) AS item_count
+  FROM new_items n
+  GROUP BY 1, 2, 3
+),
+
+bibs AS (
+  SELECT DISTINCT bib_record_id
+  FROM new_items
+),
+
+series AS (
+  SELECT
+    pes.record_id AS bib_record_id,
+    string_agg(distinct pes.index_entry, ' | ') AS series_info
+  FROM bibs b
+  JOIN sierra_view.phrase_entry pes
+    ON pes.record_id = b.bib_record_id
+    AND pes.index_tag='t'
+    AND pes.varfield_type_code='s'
+  GROUP BY 1
+),
+
+orders AS (
+  SELECT
+    bro.bib_record_id,
+    count(distinct o.id) AS order_count
+  FROM bibs b
+  JOIN sierra_view.bib_record_order_record_link bro
+    ON b.bib_record_id = bro.bib_record_id
+  JOIN sierra_view.order_record o
+    ON bro.order_record_id = o.id
+    AND o.order_status_code ='o'
+  GROUP BY 1
+),
+
+bib_holds AS (
+  SELECT
+    h.record_id AS bib_record_id,
+    count(h.id) AS hold_count
+  FROM bibs b
+  JOIN sierra_view.hold h
+    ON b.bib_record_id = h.record_id
+  GROUP BY 1
+),
+
+item_holds AS (
+  SELECT
+    n.bib_record_id,
+    n.location_code,
+    n.call_number,
+    count(distinct h.id) AS hold_count
+  FROM new_items n
+  JOIN sierra_view.hold h
+    ON n.item_id = h.record_id
+  GROUP BY 1, 2, 3
+)
+
+SELECT
+  'b'|| rmb.record_num || 'a' AS "Bib Record Num",
+  g.location_code,
+  g.call_number AS "Call#",
+  brp.best_author AS "Author",
+  brp.best_title AS "Title",
+  g.barcodes AS "Barcode",
+  s.series_info AS "Series Info",
+  g.item_count AS "Item Count",
+  COALESCE(o.order_count, 0) AS "Order Count",
+  COALESCE(bh.hold_count, 0) + COALESCE(ih.hold_count, 0) AS "Hold Count"
+FROM item_groups g
+JOIN sierra_view.record_metadata rmb
+  ON g.bib_record_id = rmb.id
+  AND rmb.record_type_code='b'
+JOIN sierra_view.bib_record_property brp
+  ON brp.bib_record_id = g.bib_record_id
+LEFT JOIN series s
+  ON g.bib_record_id = s.bib_record_id
+LEFT JOIN orders o
+  ON g.bib_record_id = o.bib_record_id
+LEFT JOIN bib_holds bh
+  ON g.bib_record_id = bh.bib_record_id
+LEFT JOIN item_holds ih
+  ON g.bib_record_id = ih.bib_record_id
+  AND g.location_code = ih.location_code
+  AND g.call_number IS NOT DISTINCT FROM ih.call_number
+ORDER BY g.location_code, "Call#", brp.best_author, brp.best_title
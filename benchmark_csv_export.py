@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""Compare the two ways of exporting a report query to csv
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Times run_query() + csv.writer, as used by write_csv() in the report scripts,
+against sierra_db.copy_csv(), which has Sierra produce the csv with COPY TO STDOUT.
+
+usage: python benchmark_csv_export.py [query.sql] [runs]
+"""
+
+import csv
+import io
+import sys
+import time
+
+import sierra_db
+
+
+# fetch the rows into Python and re-serialize them through csv.writer, as write_csv() does
+def fetch_and_write(query):
+    query_results, headers = sierra_db.run_query(query)
+    buffer = io.StringIO(newline="")
+    myFile = csv.writer(buffer, delimiter=",")
+    myFile.writerow(headers)
+    myFile.writerows(query_results)
+    return buffer.getvalue().encode("utf-8")
+
+
+# let Sierra write the csv into an in memory buffer
+def copy_to_buffer(query):
+    buffer = io.BytesIO()
+    sierra_db.copy_csv(query, buffer)
+    return buffer.getvalue()
+
+
+# run a function several times and return the fastest run in seconds along with its output
+def best_of(function, query, runs):
+    best = None
+    for run in range(runs):
+        start = time.perf_counter()
+        output = function(query)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, output
+
+
+def main():
+    query_file = sys.argv[1] if len(sys.argv) > 1 else "WeeklyNewItemsRev.sql"
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    query = open(query_file, "r").read()
+
+    # open the pooled connection before timing anything
+    sierra_db.warm_up()
+
+    write_csv_time, write_csv_output = best_of(fetch_and_write, query, runs)
+    copy_time, copy_output = best_of(copy_to_buffer, query, runs)
+
+    print("query:                 " + query_file)
+    # count through csv.reader, as quoted fields may contain line breaks
+    rows = len(list(csv.reader(io.StringIO(copy_output.decode("utf-8"))))) - 1
+    print("rows:                  {}".format(rows))
+    print(
+        "fetchall + csv.writer: {:.3f}s, {} bytes".format(
+            write_csv_time, len(write_csv_output)
+        )
+    )
+    print("COPY TO STDOUT:        {:.3f}s, {} bytes".format(copy_time, len(copy_output)))
+    print("speedup:               {:.1f}x".format(write_csv_time / copy_time))
+
+
+main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Compare writing the weekly new Excel report cell by cell with writing it a row at a time
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Times the original write_excel() loop, which wrote each cell with its own format and kept
+the whole workbook in memory, against the current one in weeklynew_2026.py, which writes
+whole rows with write_row(), takes the format from each column and streams rows out with
+xlsxwriter's constant_memory mode. Rows are generated rather than queried, and are passed to
+the constant_memory writer as an iterator, as they would arrive from sierra_db.stream_query().
+Peak memory is measured on a separate run with tracemalloc, as tracing slows the writers down.
+
+usage: python benchmark_excel_export.py [rows] [runs]
+"""
+
+import io
+import random
+import sys
+import time
+import tracemalloc
+
+import xlsxwriter
+
+LABELS = [
+    "Bib Record#", "Location", "Call#", "Author", "Title",
+    "Barcode", "Series", "Item Count", "Order Count", "Hold Count",
+]
+WIDTHS = [10.29, 6.29, 12.71, 16.57, 24.71, 11.14, 18.47, 4.5, 4.5, 4.5]
+
+
+# the original write_excel() loop, one write() call with a format per cell
+def write_by_cell(query_results, excel_file):
+    workbook = xlsxwriter.Workbook(excel_file)
+    worksheet = workbook.add_worksheet()
+    eformat = workbook.add_format({"text_wrap": True, "valign": "top"})
+    eformatlabel = workbook.add_format({"text_wrap": True, "valign": "top", "bold": True})
+    for col, width in enumerate(WIDTHS):
+        worksheet.set_column(col, col, width)
+    for col, label in enumerate(LABELS):
+        worksheet.write(0, col, label, eformatlabel)
+    for rownum, row in enumerate(query_results):
+        for col in range(10):
+            worksheet.write(rownum + 1, col, row[col], eformat)
+    workbook.close()
+
+
+# the current write_excel(), whole rows with column formats in constant_memory mode
+def write_by_row(query_results, excel_file):
+    workbook = xlsxwriter.Workbook(excel_file, {"constant_memory": True})
+    worksheet = workbook.add_worksheet()
+    eformat = workbook.add_format({"text_wrap": True, "valign": "top"})
+    eformatlabel = workbook.add_format({"text_wrap": True, "valign": "top", "bold": True})
+    for col, width in enumerate(WIDTHS):
+        worksheet.set_column(col, col, width, eformat)
+    worksheet.write_row(0, 0, LABELS, eformatlabel)
+    for rownum, row in enumerate(query_results, start=1):
+        worksheet.write_row(rownum, 0, row)
+    workbook.close()
+
+
+# generate rows shaped like the weekly new query results
+def sample_rows(count, seed=2026):
+    rng = random.Random(seed)
+    locations = ["adfic", "jfic", "adnf", "yafic"]
+    words = ["river", "night", "garden", "secret", "history", "winter", "house", "light"]
+    for row in range(count):
+        yield (
+            "b{}a".format(1000000 + row),
+            rng.choice(locations),
+            "FIC {}".format(rng.choice(words).upper()),
+            "{}, {}".format(rng.choice(words).title(), rng.choice(words).title()),
+            " ".join(rng.choice(words) for i in range(rng.randint(2, 8))).title(),
+            " ".join(str(rng.randint(31000000000000, 31999999999999)) for i in range(rng.randint(1, 3))),
+            rng.choice([None, "{} series ; {}".format(rng.choice(words).title(), rng.randint(1, 12))]),
+            rng.randint(1, 5),
+            rng.randint(0, 3),
+            rng.randint(0, 40),
+        )
+
+
+# run a writer several times on fresh rows, returning the fastest run in seconds and the file size
+def best_of(writer, row_count, runs, materialize):
+    best = None
+    for run in range(runs):
+        rows = sample_rows(row_count)
+        if materialize:
+            rows = list(rows)
+        excel_file = io.BytesIO()
+        start = time.perf_counter()
+        writer(rows, excel_file)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, len(excel_file.getvalue())
+
+
+# peak memory allocated by Python while a writer runs, including the rows it is given
+def peak_memory(writer, row_count, materialize):
+    tracemalloc.start()
+    rows = sample_rows(row_count)
+    if materialize:
+        rows = list(rows)
+    writer(rows, io.BytesIO())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main(row_count=100000, runs=3):
+    # the original writer was given the full fetchall() results, the constant_memory one a row iterator
+    cell_time, cell_size = best_of(write_by_cell, row_count, runs, True)
+    row_time, row_size = best_of(write_by_row, row_count, runs, False)
+    cell_peak = peak_memory(write_by_cell, row_count, True)
+    row_peak = peak_memory(write_by_row, row_count, False)
+
+    print("rows:                    {}".format(row_count))
+    print(
+        "write() per cell:        {:.3f}s, {} bytes, peak memory {:.1f} MB".format(
+            cell_time, cell_size, cell_peak / 1048576
+        )
+    )
+    print(
+        "write_row() streaming:   {:.3f}s, {} bytes, peak memory {:.1f} MB".format(
+            row_time, row_size, row_peak / 1048576
+        )
+    )
+    print("speedup:                 {:.1f}x".format(cell_time / row_time))
+
+
+main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""Profile how long a script spends importing modules before it can start work
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Each script's import statements are found without running it and imported in a fresh
+interpreter with python -X importtime. Startup covers only the imports at the top of the
+script, which is what every run pays. All imports adds the ones made inside functions, which
+the Checkin and Ingram scripts now leave until the code path that needs them, such as the
+Google client libraries that are only loaded when there are errors to log. The packages
+that took longest to import are listed under each. A package that is not installed is
+reported as an error, not timed.
+
+usage: python benchmark_startup.py [script ...] [runs]
+"""
+
+import ast
+import os
+import subprocess
+import sys
+import time
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = [
+    "Correct Checkin Errors.py",
+    "Correct Checkin Errors_v2.py",
+    os.path.join("Ingram Holdings", "Ingram Holdings.py"),
+]
+
+
+# source of a script's import statements, either those at the top of the script or every one in it
+def script_imports(script, top_level=True):
+    with open(script, encoding="utf-8") as f:
+        source = f.read()
+    tree = ast.parse(source)
+    nodes = tree.body if top_level else ast.walk(tree)
+    return "\n".join(
+        ast.get_source_segment(source, node)
+        for node in nodes
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+
+# import the statements in a new interpreter from the script's directory, with the shared modules on the path
+# returns the wall clock seconds and the -X importtime report, or raises RuntimeError if an import failed
+def time_imports(script, imports):
+    env = dict(os.environ, PYTHONPATH=REPOSITORY)
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", imports],
+        cwd=os.path.dirname(os.path.abspath(script)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return elapsed, result.stderr
+
+
+# cumulative microseconds for each package imported directly, rather than by another package
+def top_level_packages(report):
+    packages = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # nested imports are indented under the package that imported them
+        if not name[1:].startswith(" "):
+            packages[name.strip()] = int(cumulative_us)
+    return packages
+
+
+# profile one set of imports several times, keeping the fastest run
+def profile_imports(script, imports, runs):
+    best = None
+    for run in range(runs):
+        elapsed, report = time_imports(script, imports)
+        if best is None or elapsed < best[0]:
+            best = (elapsed, report)
+    return best[0], top_level_packages(best[1])
+
+
+def print_profile(label, elapsed, packages, slowest=5):
+    print(
+        "  {:<12} {:7.1f} ms wall clock, {:7.1f} ms importing".format(
+            label, elapsed * 1000, sum(packages.values()) / 1000
+        )
+    )
+    for name, cumulative_us in sorted(packages.items(), key=lambda item: -item[1])[:slowest]:
+        print("      {:7.1f} ms  {}".format(cumulative_us / 1000, name))
+
+
+def main(scripts, runs=3):
+    for script in scripts:
+        print(script)
+        for label, top_level in (("startup", True), ("all imports", False)):
+            try:
+                elapsed, packages = profile_imports(script, script_imports(script, top_level), runs)
+            except RuntimeError as e:
+                print("  {:<12} {}".format(label, e))
+                continue
+            print_profile(label, elapsed, packages)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    runs = 3
+    if args and args[-1].isdigit():
+        runs = int(args.pop())
+    main([os.path.join(REPOSITORY, script) for script in args or SCRIPTS], runs)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""Check that WeeklyNewItemsOptimized.sql returns the same rows as WeeklyNewItemsRev.sql and time both
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Rows are compared after sorting, as rows that tie on the ORDER BY columns may come back
+in either order. Pass --mirror to run both queries against the local sierra_mirror copy
+rather than Sierra. DuckDB does not sort the values inside string_agg(distinct ...) the way
+Postgres does, so the Barcode and Series Info columns may differ in order there.
+
+usage: python benchmark_weeklynew_query.py [runs] [--mirror]
+"""
+
+import sys
+import time
+
+import sierra_db
+import sierra_mirror
+
+ORIGINAL_QUERY = "WeeklyNewItemsRev.sql"
+OPTIMIZED_QUERY = "WeeklyNewItemsOptimized.sql"
+
+
+# run a query several times, returning the fastest run in seconds with its results
+def best_of(run_query, query, runs):
+    best = None
+    for run in range(runs):
+        start = time.perf_counter()
+        rows, columns = run_query(query)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, rows, columns
+
+
+# sort rows so that they can be compared regardless of how ties in the ORDER BY were broken
+def sorted_rows(rows):
+    return sorted(rows, key=lambda row: tuple((value is None, str(value)) for value in row))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 3
+    if "--mirror" in sys.argv:
+        run_query = sierra_mirror.run_query
+    else:
+        run_query = sierra_db.run_query
+        # open the pooled connection before timing anything
+        sierra_db.warm_up()
+
+    original_time, original_rows, original_columns = best_of(
+        run_query, sierra_db.load_query(ORIGINAL_QUERY), runs
+    )
+    optimized_time, optimized_rows, optimized_columns = best_of(
+        run_query, sierra_db.load_query(OPTIMIZED_QUERY), runs
+    )
+
+    print("{}: {} rows, {:.3f}s".format(ORIGINAL_QUERY, len(original_rows), original_time))
+    print("{}: {} rows, {:.3f}s".format(OPTIMIZED_QUERY, len(optimized_rows), optimized_time))
+    print("speedup: {:.1f}x".format(original_time / optimized_time))
+
+    # compare column headers and then every row
+    matches = original_columns == optimized_columns
+    if not matches:
+        print("column headers differ:")
+        print("  " + str(original_columns))
+        print("  " + str(optimized_columns))
+
+    differences = 0
+    for original_row, optimized_row in zip(
+        sorted_rows(original_rows), sorted_rows(optimized_rows)
+    ):
+        if original_row != optimized_row:
+            differences += 1
+            # only print the first few mismatches
+            if differences <= 10:
+                print("row differs:")
+                print("  original:  " + str(original_row))
+                print("  optimized: " + str(optimized_row))
+    if differences or len(original_rows) != len(optimized_rows):
+        matches = False
+        print("{} rows differ".format(differences + abs(len(original_rows) - len(optimized_rows))))
+
+    if matches:
+        print("results match row for row")
+    else:
+        sys.exit(1)
+
+
+main()
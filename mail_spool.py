@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""Keep outgoing emails in a local spool so an interrupted run can pick up where it stopped
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Rendered messages are saved to a SQLite file with one entry per notice and key, such as a
+patron id, before any are sent. deliver_spool() sends the entries that have not gone out yet
+through smtp_delivery and records each one as soon as it is sent. If a run crashes or the mail
+server goes down partway, running it again only sends the remaining messages, and a patron
+is never sent the same notice twice. Messages that fail are retried on later runs. Only a
+message the mail server refuses outright counts towards MAX_ATTEMPTS, so messages caught by an
+outage are always left to send once the server is back.
+"""
+
+import email
+import json
+import smtplib
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+MAX_ATTEMPTS = 3
+
+# guards the spool connection, which is shared with the sending threads
+spool_lock = threading.Lock()
+
+
+# open the spool, creating its table on first use
+def open_spool(spool_file="mail_spool.db"):
+    spool = sqlite3.connect(spool_file, check_same_thread=False)
+    spool.execute("PRAGMA journal_mode=WAL")
+    # with WAL, NORMAL still keeps every commit through a crash of the script, only a power loss can lose the last few
+    spool.execute("PRAGMA synchronous=NORMAL")
+    spool.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message (
+          notice TEXT,
+          key TEXT,
+          recipients TEXT,
+          message TEXT,
+          status TEXT DEFAULT 'pending',
+          attempts INTEGER DEFAULT 0,
+          error TEXT,
+          queued TEXT,
+          sent TEXT,
+          PRIMARY KEY (notice, key)
+        )"""
+    )
+    spool.execute(
+        "CREATE TABLE IF NOT EXISTS spooled_notice (notice TEXT PRIMARY KEY, completed TEXT)"
+    )
+    return spool
+
+
+# check whether every message for a notice has been spooled, in which case it should not be queried and rendered again
+def notice_complete(spool, notice):
+    with spool_lock:
+        row = spool.execute(
+            "SELECT 1 FROM spooled_notice WHERE notice = ?", (notice,)
+        ).fetchone()
+    return row is not None
+
+
+# record that every message for a notice has been spooled
+def mark_complete(spool, notice):
+    with spool_lock:
+        spool.execute(
+            "INSERT OR REPLACE INTO spooled_notice VALUES (?, ?)",
+            (notice, datetime.now().isoformat(timespec="seconds")),
+        )
+        spool.commit()
+
+
+# save (key, recipients, msg) tuples for a notice, returning how many were new
+# a key that is already in the spool for the notice is left as it is, so nothing is sent twice
+def spool_messages(spool, notice, messages):
+    queued = datetime.now().isoformat(timespec="seconds")
+    with spool_lock:
+        before = spool.total_changes
+        spool.executemany(
+            "INSERT OR IGNORE INTO message (notice, key, recipients, message, queued) VALUES (?, ?, ?, ?, ?)",
+            (
+                (notice, str(key), json.dumps(recipients), msg.as_string(), queued)
+                for key, recipients, msg in messages
+            ),
+        )
+        spool.commit()
+        return spool.total_changes - before
+
+
+# spool (key, recipients, msg) tuples for a notice one at a time as they arrive, passing on the ones still to be sent
+# keyed by (notice, key) for DeliveryEngine.deliver(), so messages can be sent while later ones are still being rendered
+# messages already sent by an earlier run are skipped
+def spool_through(spool, notice, messages):
+    for key, recipients, msg in messages:
+        notice_key = (notice, str(key))
+        with spool_lock:
+            spool.execute(
+                "INSERT OR IGNORE INTO message (notice, key, recipients, message, queued) VALUES (?, ?, ?, ?, ?)",
+                notice_key
+                + (json.dumps(recipients), msg.as_string(), datetime.now().isoformat(timespec="seconds")),
+            )
+            spool.commit()
+            status, attempts = spool.execute(
+                "SELECT status, attempts FROM message WHERE notice = ? AND key = ?",
+                notice_key,
+            ).fetchone()
+        if status != "sent" and attempts < MAX_ATTEMPTS:
+            yield notice_key, recipients, msg
+
+
+# yield the (key, recipients, msg) tuples still to be sent, keyed by (notice, key) for deliver_spool()
+# only the keys are read up front, each message is loaded as it is needed
+def unsent_messages(spool, notice=None):
+    query = "SELECT notice, key FROM message WHERE status != 'sent' AND attempts < ?"
+    params = [MAX_ATTEMPTS]
+    if notice is not None:
+        query += " AND notice = ?"
+        params.append(notice)
+    with spool_lock:
+        keys = spool.execute(query + " ORDER BY queued, key", params).fetchall()
+
+    for notice_key in keys:
+        with spool_lock:
+            recipients, message = spool.execute(
+                "SELECT recipients, message FROM message WHERE notice = ? AND key = ?",
+                notice_key,
+            ).fetchone()
+        yield notice_key, json.loads(recipients), email.message_from_string(message)
+
+
+# record a message as sent, committed straight away so it survives a crash
+def mark_sent(spool, notice_key):
+    with spool_lock:
+        spool.execute(
+            "UPDATE message SET status = 'sent', attempts = attempts + 1, error = NULL, sent = ? WHERE notice = ? AND key = ?",
+            (datetime.now().isoformat(timespec="seconds"),) + tuple(notice_key),
+        )
+        spool.commit()
+
+
+# record a failed attempt at sending a message
+# the attempt only counts when the server refused the message itself, not when the connection or session failed
+def mark_failed(spool, notice_key, error):
+    refused = isinstance(error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError))
+    with spool_lock:
+        spool.execute(
+            "UPDATE message SET status = 'failed', attempts = attempts + ?, error = ? WHERE notice = ? AND key = ?",
+            (int(refused), str(error)) + tuple(notice_key),
+        )
+        spool.commit()
+
+
+# send everything in the spool that has not been sent, optionally only for one notice
+# messages can instead be passed in from spool_through(), to send them as they are spooled
+# returns the number of messages sent and failed
+def deliver_spool(spool, engine, notice=None, messages=None):
+    if messages is None:
+        messages = unsent_messages(spool, notice)
+    return engine.deliver(
+        messages,
+        on_sent=lambda notice_key: mark_sent(spool, notice_key),
+        on_failed=lambda notice_key, error: mark_failed(spool, notice_key, error),
+    )
+
+
+# remove messages queued more than keep_days ago
+def purge(spool, keep_days=90):
+    cutoff = (datetime.now() - timedelta(days=keep_days)).isoformat(timespec="seconds")
+    with spool_lock:
+        spool.execute("DELETE FROM message WHERE queued < ?", (cutoff,))
+        spool.execute("DELETE FROM spooled_notice WHERE completed < ?", (cutoff,))
+        spool.commit()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""Capture query plans and timings for the report queries
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Runs a query with EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) and saves the plan along with
+its timing, row count and buffer usage to a log, flagging sequential scans and places
+where the planner's row estimate was far off. Profiling is turned on for every query a
+script runs through sierra_db by adding profile = true to that script's database section
+of config.ini. Note that EXPLAIN ANALYZE executes the query, so profiled queries run twice.
+
+usage: python query_profiler.py query.sql [query.sql ...] [--section db] [--param name=value ...]
+--section picks the config.ini database section, and each --param fills a %(name)s placeholder
+with a text value. Queries with array parameters, such as Ingram's multi_ingram_holdings.sql,
+are profiled by setting profile = true in the [sql] section and running the script instead.
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+
+import settings
+import sierra_db
+
+# flag plan nodes whose actual row count is this many times higher or lower than estimated
+ESTIMATE_MISS_RATIO = 10
+
+
+# run EXPLAIN ANALYZE on a query and return the plan as parsed JSON
+def explain(query, params=None, section="db"):
+    query = query.strip().rstrip(";")
+    with sierra_db.connection(section) as conn:
+        cursor = conn.cursor()
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)\n" + query, params)
+        plan = cursor.fetchone()[0]
+        cursor.close()
+    # psycopg2 normally parses the json, but older servers may return it as text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+# walk every node in a plan tree
+def plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+# summarize a plan: timing, rows, buffers, sequential scans and row estimate misses
+def summarize(plan):
+    top = plan["Plan"]
+    seq_scans = []
+    estimate_misses = []
+    for node in plan_nodes(top):
+        if node["Node Type"] == "Seq Scan":
+            seq_scans.append(
+                {
+                    "relation": node.get("Relation Name"),
+                    "rows": node.get("Actual Rows", 0) * node.get("Actual Loops", 1),
+                }
+            )
+        # compare per loop figures, as Plan Rows is the estimate for a single loop
+        estimated = max(node.get("Plan Rows", 0), 1)
+        actual = max(node.get("Actual Rows", 0), 1)
+        if max(estimated, actual) / min(estimated, actual) >= ESTIMATE_MISS_RATIO:
+            estimate_misses.append(
+                {
+                    "node": node["Node Type"],
+                    "relation": node.get("Relation Name"),
+                    "estimated_rows": node.get("Plan Rows", 0),
+                    "actual_rows": node.get("Actual Rows", 0),
+                }
+            )
+
+    return {
+        "planning_ms": plan.get("Planning Time"),
+        "execution_ms": plan.get("Execution Time"),
+        "rows": top.get("Actual Rows", 0) * top.get("Actual Loops", 1),
+        "shared_hit_blocks": top.get("Shared Hit Blocks", 0),
+        "shared_read_blocks": top.get("Shared Read Blocks", 0),
+        "seq_scans": seq_scans,
+        "estimate_misses": estimate_misses,
+    }
+
+
+# append a profile to the log file, one JSON document per line
+def save_profile(report, query, params, plan, summary):
+    config = settings.load()
+    """
+    [profile]
+    log = query_profiles.jsonl
+    """
+    log_file = "query_profiles.jsonl"
+    if "profile" in config:
+        log_file = config["profile"].get("log", log_file)
+
+    entry = {
+        "report": report,
+        "profiled": datetime.now().isoformat(timespec="seconds"),
+        "query": query,
+        "params": params,
+        "summary": summary,
+        "plan": plan,
+    }
+    with open(log_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, default=str) + "\n")
+
+
+# print a short summary of a profile
+def print_summary(report, summary):
+    print(
+        "{}: {} rows, planning {:.1f} ms, execution {:.1f} ms, buffers hit {} read {}".format(
+            report,
+            summary["rows"],
+            summary["planning_ms"] or 0,
+            summary["execution_ms"] or 0,
+            summary["shared_hit_blocks"],
+            summary["shared_read_blocks"],
+        )
+    )
+    for scan in summary["seq_scans"]:
+        print("  seq scan on {} ({} rows)".format(scan["relation"], scan["rows"]))
+    for miss in summary["estimate_misses"]:
+        print(
+            "  row estimate miss at {} {}: estimated {}, actual {}".format(
+                miss["node"],
+                miss["relation"] or "",
+                miss["estimated_rows"],
+                miss["actual_rows"],
+            )
+        )
+
+
+# profile a query, save the results and return the summary
+# report defaults to the name of the script being run
+def profile_query(query, params=None, section="db", report=None):
+    if report is None:
+        report = os.path.basename(sys.argv[0])
+    plan = explain(query, params, section)
+    summary = summarize(plan)
+    save_profile(report, query, params, plan, summary)
+    print_summary(report, summary)
+    return summary
+
+
+# split the command line into the sql files, the config.ini section and the query parameters
+def parse_args(args):
+    sql_files, section, params = [], "db", {}
+    args = iter(args)
+    for arg in args:
+        if arg == "--section":
+            section = next(args)
+        elif arg == "--param":
+            name, value = next(args).split("=", 1)
+            params[name] = value
+        else:
+            sql_files.append(arg)
+    return sql_files, section, params or None
+
+
+if __name__ == "__main__":
+    sql_files, section, params = parse_args(sys.argv[1:])
+    for sql_file in sql_files:
+        profile_query(sierra_db.load_query(sql_file), params, section, report=sql_file)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""Build report attachments in memory rather than writing them to the working directory
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+new_artifact() returns a binary buffer that stays in memory until it grows past spool_mb,
+after which it moves to a temporary file that is deleted when closed. Reports write their
+.csv or .xlsx into it and attachment_part() turns it straight into the MIME part for the
+email, zipping it first when it is over zip_mb (.xlsx files are zip archives already, so they
+are sent as they are). Both sizes can be set in an optional [artifacts] section of config.ini:
+
+[artifacts]
+spool_mb = 16
+zip_mb = 5
+"""
+
+import codecs
+import io
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from email import encoders
+from email.mime.base import MIMEBase
+
+import settings
+
+# attachment types that would not get any smaller by being zipped
+ALREADY_COMPRESSED = (".xlsx", ".zip")
+
+
+# read the [artifacts] settings, in bytes
+def artifact_settings():
+    config = settings.load()
+    spool_mb, zip_mb = 16, 5
+    if "artifacts" in config:
+        spool_mb = config["artifacts"].getfloat("spool_mb", spool_mb)
+        zip_mb = config["artifacts"].getfloat("zip_mb", zip_mb)
+    return {"spool_bytes": int(spool_mb * 1048576), "zip_bytes": int(zip_mb * 1048576)}
+
+
+# a binary buffer held in memory until it passes spool_mb, then moved to a temporary file
+def new_artifact():
+    return tempfile.SpooledTemporaryFile(
+        max_size=artifact_settings()["spool_bytes"], mode="w+b"
+    )
+
+
+# a utf-8 text stream over an artifact for csv.writer, which writes its line endings unchanged
+# each write is encoded and passed straight to the artifact, as io.TextIOWrapper cannot wrap a
+# SpooledTemporaryFile before Python 3.11, and the artifact is left open once the block ends
+@contextmanager
+def text_writer(artifact):
+    yield codecs.getwriter("utf-8")(artifact)
+
+
+# build the email attachment for an artifact, zipping it first if it is larger than zip_mb
+def attachment_part(artifact, filename):
+    artifact.seek(0, io.SEEK_END)
+    size = artifact.tell()
+    artifact.seek(0)
+
+    if size > artifact_settings()["zip_bytes"] and not filename.endswith(ALREADY_COMPRESSED):
+        zipped = new_artifact()
+        with zipfile.ZipFile(zipped, "w", zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(filename, "w") as member:
+                shutil.copyfileobj(artifact, member)
+        zipped.seek(0)
+        part = MIMEBase("application", "zip")
+        part.set_payload(zipped.read())
+        zipped.close()
+        filename += ".zip"
+    else:
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(artifact.read())
+
+    encoders.encode_base64(part)
+    part.add_header("Content-Disposition", "attachment; filename=%s" % filename)
+    return part
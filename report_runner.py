@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+"""Run the reports declared in reports.ini from a single process
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Each report in reports.ini names its query file, parameters, output format, recipients and
+schedule. The runner runs the reports in a pool of worker threads, querying Sierra on the shared
+sierra_db connection pool and building each attachment in memory with report_artifacts. Every
+email goes out over one set of smtp_delivery sessions as soon as its report is finished. One
+report's query therefore overlaps with another's Excel rendering and email. A failed report
+is reported and skipped so the rest of the batch still runs.
+
+The number of reports run at once and the number of Sierra queries they may have open at once
+are set in an optional [reports] section of config.ini. max_queries keeps a large batch from
+loading the ILS, and pool_max in the database section should be at least as large:
+
+[reports]
+workers = 4
+max_queries = 2
+
+A section with a script instead of a sql file is a script job, such as the Ingram holdings
+upload. The script is run with its args from its own directory, alongside the reports.
+
+usage: python report_runner.py [report ...] [--all] [--list]
+with no reports named, the reports scheduled for today are run
+"""
+
+import configparser
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+import report_artifacts
+import settings
+import sierra_db
+import smtp_delivery
+import xlsxwriter
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+# read the [reports] settings for the number of reports and Sierra queries run at once
+def runner_settings():
+    config = settings.load()
+    workers, max_queries = 4, 2
+    if "reports" in config:
+        workers = config["reports"].getint("workers", workers)
+        max_queries = config["reports"].getint("max_queries", max_queries)
+    return {"workers": workers, "max_queries": max_queries}
+
+
+# check that a schedule is daily, weekly <day> or monthly <day of month>, raising ValueError if not
+def check_schedule(name, schedule):
+    parts = schedule.lower().split()
+    if parts == ["daily"]:
+        return
+    if len(parts) == 2 and parts[0] == "weekly" and parts[1] in WEEKDAYS:
+        return
+    if len(parts) == 2 and parts[0] == "monthly" and parts[1].isdigit() and 1 <= int(parts[1]) <= 31:
+        return
+    raise ValueError(
+        "Report {} has schedule '{}', expected daily, weekly <day> or monthly <day of month>".format(
+            name, schedule
+        )
+    )
+
+
+# read the report declarations, returning a dictionary of settings keyed by report name
+# sections with a script are script jobs, which run a Python script instead of a query
+def load_registry(registry_file="reports.ini"):
+    registry = configparser.ConfigParser(interpolation=None)
+    registry.read(registry_file)
+
+    reports = {}
+    for name in registry.sections():
+        report = registry[name]
+        schedule = report.get("schedule", "daily")
+        check_schedule(name, schedule)
+        if "script" in report:
+            reports[name] = {
+                "kind": "script",
+                "script": report["script"],
+                "args": shlex.split(report.get("args", "")),
+                "schedule": schedule,
+            }
+            continue
+        reports[name] = {
+            "kind": "query",
+            "sql": report["sql"],
+            "database": report.get("database", "db"),
+            "params": {
+                key[len("param_"):]: value
+                for key, value in report.items()
+                if key.startswith("param_")
+            },
+            "format": report.get("format", "csv"),
+            "filename": report["filename"],
+            "recipients": [address.strip() for address in report["recipients"].split(",")],
+            "subject": report["subject"],
+            "message": report.get("message", ""),
+            "schedule": schedule,
+            "column_widths": [
+                float(width) for width in report.get("column_widths", "").split(",") if width.strip()
+            ],
+            "sheet_header": report.get("sheet_header", ""),
+        }
+    return reports
+
+
+# check whether a report's schedule includes a given day
+def is_due(report, day):
+    schedule = report["schedule"].lower().split()
+    if schedule[0] == "daily":
+        return True
+    if schedule[0] == "weekly":
+        return WEEKDAYS[day.weekday()] == schedule[1]
+    return day.day == int(schedule[1])
+
+
+# stream query results into an Excel artifact, using the query's column names as labels
+def write_excel(report, query_results, headers):
+    excel_file = report_artifacts.new_artifact()
+    workbook = xlsxwriter.Workbook(excel_file, {"constant_memory": True})
+    worksheet = workbook.add_worksheet()
+    worksheet.set_landscape()
+    worksheet.hide_gridlines(0)
+
+    eformat = workbook.add_format({"text_wrap": True, "valign": "top"})
+    eformatlabel = workbook.add_format({"text_wrap": True, "valign": "top", "bold": True})
+    for col, width in enumerate(report["column_widths"]):
+        worksheet.set_column(col, col, width, eformat)
+    if report["sheet_header"]:
+        worksheet.set_header("&C" + report["sheet_header"])
+
+    worksheet.write_row(0, 0, headers, eformatlabel)
+    for rownum, row in enumerate(query_results, start=1):
+        worksheet.write_row(rownum, 0, row)
+
+    workbook.close()
+    return excel_file
+
+
+# run a report's query and build its attachment, holding one of the query_slots while Sierra is in use
+# csv reports are written by Sierra with COPY, xlsx reports are streamed from a server side cursor
+def build_artifact(report, query_slots):
+    query = sierra_db.load_query(report["sql"])
+    params = report["params"] or None
+
+    if report["format"] == "csv":
+        with query_slots:
+            return sierra_db.copy_csv(
+                query, report_artifacts.new_artifact(), report["database"], params=params
+            )
+    if report["format"] == "xlsx":
+        with query_slots, sierra_db.stream_query(
+            query, report["database"], params=params
+        ) as (query_results, headers):
+            return write_excel(report, query_results, headers)
+    raise ValueError("Unknown format: " + report["format"])
+
+
+# build the email for a report with its attachment
+def build_email(report, artifact, emailfrom):
+    msg = MIMEMultipart()
+    msg["From"] = emailfrom
+    msg["To"] = ", ".join(report["recipients"])
+    msg["Date"] = formatdate(localtime=True)
+    msg["Subject"] = report["subject"]
+    msg.attach(MIMEText(report["message"]))
+    msg.attach(report_artifacts.attachment_part(artifact, report["filename"]))
+    return msg
+
+
+# build a report's attachment and email, closing the attachment once it is in the email
+def run_report(report, emailfrom, query_slots):
+    artifact = build_artifact(report, query_slots)
+    try:
+        return build_email(report, artifact, emailfrom)
+    finally:
+        artifact.close()
+
+
+# run a script job from its own directory, so it finds its config.ini and query files as it does when run by hand
+# the script queries Sierra itself, so it holds one of the query_slots while it runs
+def run_script(report, query_slots):
+    script = os.path.abspath(report["script"])
+    with query_slots:
+        subprocess.run(
+            [sys.executable, script] + report["args"], cwd=os.path.dirname(script), check=True
+        )
+
+
+# run the reports in a pool of worker threads, yielding each email for smtp_delivery as its report finishes
+# script jobs run in the same pool and send their own output, so they yield nothing
+# failed reports are added to the failures list rather than stopping the batch
+def run_reports(reports, emailfrom, failures, workers=4, max_queries=2):
+    query_slots = threading.BoundedSemaphore(max_queries)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for name, report in reports.items():
+            if report["kind"] == "script":
+                future = executor.submit(run_script, report, query_slots)
+            else:
+                future = executor.submit(run_report, report, emailfrom, query_slots)
+            futures[future] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                msg = future.result()
+            except Exception as e:
+                print("Report {} failed: {}".format(name, e))
+                failures.append(name)
+                continue
+            if reports[name]["kind"] == "script":
+                print("Script {} finished".format(name))
+                continue
+            print("Report {} built".format(name))
+            yield name, reports[name]["recipients"], msg
+
+
+def main(args):
+    reports = load_registry()
+
+    if "--list" in args:
+        for name, report in reports.items():
+            if report["kind"] == "script":
+                print("{}: script {}, {}".format(name, report["script"], report["schedule"]))
+            else:
+                print("{}: {} as {}, {}".format(name, report["sql"], report["format"], report["schedule"]))
+        return
+
+    names = [arg for arg in args if not arg.startswith("--")]
+    unknown = [name for name in names if name not in reports]
+    if unknown:
+        print("Unknown reports: " + ", ".join(unknown))
+        sys.exit(1)
+
+    if names:
+        reports = {name: reports[name] for name in names}
+    elif "--all" not in args:
+        reports = {name: report for name, report in reports.items() if is_due(report, date.today())}
+
+    # open each database connection once, before running anything
+    for section in sorted(set(report["database"] for report in reports.values() if report["kind"] == "query")):
+        sierra_db.warm_up(section)
+
+    limits = runner_settings()
+    failures = []
+    start = time.perf_counter()
+    engine = smtp_delivery.DeliveryEngine()
+    engine.deliver(
+        run_reports(
+            reports,
+            engine.settings["sender"],
+            failures,
+            workers=limits["workers"],
+            max_queries=limits["max_queries"],
+        ),
+        on_failed=lambda name, error: failures.append(name),
+    )
+    print("Ran {} reports in {:.1f}s".format(len(reports), time.perf_counter() - start))
+    if failures:
+        print("Failed reports: " + ", ".join(failures))
+        sys.exit(1)
+
+
+main(sys.argv[1:])
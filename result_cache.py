@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""Local on-disk cache of Sierra query results
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Results are saved by a key built from the SQL text, its parameters and the date window
+the report covers, so a report that has to be re-sent (a bounced email, a new recipient)
+can be rebuilt from the saved rows without querying Sierra again.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+from datetime import date, timedelta
+
+import settings
+import sierra_db
+
+
+# read cache settings from config.ini, all of which are optional
+def cache_settings():
+    config = settings.load()
+    """
+    [cache]
+    directory = report_cache
+    ttl_hours = 168
+    max_mb = 200
+    """
+    # fallback covers both a missing [cache] section and a missing option
+    return (
+        config.get("cache", "directory", fallback="report_cache"),
+        config.getfloat("cache", "ttl_hours", fallback=168) * 3600,
+        config.getfloat("cache", "max_mb", fallback=200) * 1024 * 1024,
+    )
+
+
+# build the cache key for a query, its parameters and the date window it covers
+# window defaults to today, pass eg. the first day of the week for weekly reports
+def cache_key(query, params=None, window=None):
+    if window is None:
+        window = date.today()
+    key_source = json.dumps(
+        [query, params or {}, str(window)], sort_keys=True, default=str
+    )
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+# the Sunday starting the current week, matching NOW()::DATE-EXTRACT(DOW FROM NOW()) in the weekly reports
+# used as the window for weekly reports, so a re-send later in the week still finds the saved results
+def week_window():
+    today = date.today()
+    return today - timedelta(days=today.isoweekday() % 7)
+
+
+# return the saved rows and column headers for a key, or None if missing or expired
+def get(key):
+    directory, ttl, max_size = cache_settings()
+    cache_file = os.path.join(directory, key + ".pickle")
+    try:
+        with open(cache_file, "rb") as f:
+            created, rows, columns = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if time.time() - created > ttl:
+        os.remove(cache_file)
+        return None
+    # update the access time so size based eviction removes the least recently used results first
+    # the modified time is left alone as it records when the results were saved
+    os.utime(cache_file, (time.time(), os.stat(cache_file).st_mtime))
+    return rows, columns
+
+
+# save rows and column headers under a key, then trim the cache back under its size limit
+def put(key, rows, columns):
+    directory, ttl, max_size = cache_settings()
+    os.makedirs(directory, exist_ok=True)
+    cache_file = os.path.join(directory, key + ".pickle")
+    # write to a temporary file first so an interrupted run never leaves a partial entry
+    with open(cache_file + ".tmp", "wb") as f:
+        pickle.dump((time.time(), rows, columns), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file + ".tmp", cache_file)
+    evict()
+
+
+# remove expired entries, then the least recently used entries until the cache fits in max_mb
+def evict():
+    directory, ttl, max_size = cache_settings()
+    if not os.path.isdir(directory):
+        return
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(".pickle"):
+            continue
+        path = os.path.join(directory, name)
+        stat = os.stat(path)
+        if time.time() - stat.st_mtime > ttl:
+            os.remove(path)
+        else:
+            entries.append((stat.st_atime, stat.st_size, path))
+
+    total_size = sum(size for used, size, path in entries)
+    for used, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(path)
+        total_size -= size
+
+
+# run a query through the cache, returning rows and column headers
+# refresh=True always queries Sierra and saves the new results, as a normal scheduled run should
+# refresh=False rebuilds a report from its saved results for re-sending it, and raises LookupError if
+# there are none rather than quietly sending fresh results that differ from the original report
+def cached_query(query, params=None, section="db", window=None, refresh=True):
+    key = cache_key(query, params, window)
+    if not refresh:
+        cached = get(key)
+        if cached is None:
+            raise LookupError(
+                "No saved results to re-send for params {} in window {}, run the report normally to query Sierra".format(
+                    params, window
+                )
+            )
+        return cached
+    rows, columns = sierra_db.run_prepared(query, params, section)
+    put(key, rows, columns)
+    return rows, columns
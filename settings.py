@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+"""Settings files parsed once per process and shared by the report scripts
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+load() reads an .ini file such as config.ini the first time it is asked for and hands the
+same ConfigParser back on every later call. Helpers that look up a setting each time they run,
+such as opening a connection or sending an email, no longer parse the file again. Files are
+keyed by their full path, so scripts that change directory still get the right one. The
+returned ConfigParser is shared and should be treated as read only.
+"""
+
+import configparser
+import os
+import threading
+
+# parsed settings files, keyed by absolute path
+_files = {}
+_files_lock = threading.Lock()
+
+
+# return the parsed settings file, reading it on first use
+def load(filename="config.ini"):
+    path = os.path.abspath(filename)
+    with _files_lock:
+        if path not in _files:
+            config = configparser.ConfigParser()
+            config.read(path)
+            _files[path] = config
+        return _files[path]
+
+
+# forget every parsed file, so the next load() reads it again (eg. after a file is edited)
+def reload():
+    with _files_lock:
+        _files.clear()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""Upload files over SFTP, reusing one connection per host and login
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+UploadManager keeps a connection open for each host, username and password it uploads to,
+so sending several files with the same login costs a single handshake. Each connection
+carries one transfer at a time, while transfers for different logins run concurrently, up
+to max_workers at once. The size, time and bytes/s of every transfer are printed.
+
+Connections are opened by the connect function given to UploadManager, pysftp by default.
+LocalSFTP is a stand-in that writes into a local directory instead, for dry runs and for
+trying scripts out without an SFTP server:
+
+    uploads = UploadManager(functools.partial(LocalSFTP, "upload_test"))
+"""
+
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+# open a pysftp connection, without checking the host key
+def pysftp_connect(host, username, password):
+    # only needed when uploading for real
+    import pysftp
+
+    cnopts = pysftp.CnOpts()
+    cnopts.hostkeys = None
+    return pysftp.Connection(
+        host=host, username=username, password=password, cnopts=cnopts
+    )
+
+
+# stand-in for a pysftp connection that keeps uploads in root/host/username on the local disk
+# supports the parts of pysftp used by the report scripts: put, open, exists, stat, truncate, rename, remove and close
+class LocalSFTP:
+    def __init__(self, root, host, username, password):
+        self.directory = os.path.join(root, host, username)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, remote_file):
+        return os.path.join(self.directory, os.path.basename(remote_file))
+
+    def put(self, localpath, remotepath=None):
+        # like pysftp, upload to the file's own name unless told otherwise
+        shutil.copyfile(localpath, self.path(remotepath or localpath.replace("\\", "/")))
+
+    def open(self, remote_file, mode="r"):
+        return open(self.path(remote_file), mode)
+
+    def exists(self, remote_file):
+        return os.path.exists(self.path(remote_file))
+
+    def stat(self, remote_file):
+        return os.stat(self.path(remote_file))
+
+    def truncate(self, remote_file, size):
+        os.truncate(self.path(remote_file), size)
+
+    def rename(self, remote_src, remote_dest):
+        os.rename(self.path(remote_src), self.path(remote_dest))
+
+    def remove(self, remote_file):
+        os.remove(self.path(remote_file))
+
+    def close(self):
+        pass
+
+
+class UploadManager:
+    def __init__(self, connect=pysftp_connect, max_workers=4):
+        self.connect = connect
+        self.max_workers = max_workers
+        # (host, username, password) -> [connection or None, lock held while it is in use]
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.transfers = threading.BoundedSemaphore(max_workers)
+
+    # borrow the connection for a login, opening it on first use
+    # if anything goes wrong while it is borrowed, it is closed and a new one is opened next time
+    @contextmanager
+    def session(self, host, username, password):
+        key = (host, username, password)
+        with self.sessions_lock:
+            entry = self.sessions.setdefault(key, [None, threading.Lock()])
+
+        with self.transfers, entry[1]:
+            if entry[0] is None:
+                entry[0] = self.connect(host, username, password)
+            try:
+                yield entry[0]
+            except BaseException:
+                self.discard(entry)
+                raise
+
+    # close a session's connection, ignoring errors from one that has already failed
+    def discard(self, entry):
+        connection, entry[0] = entry[0], None
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    # upload a file to the root directory for a login, returning the transfer's statistics
+    def upload(self, local_file, host, username, password):
+        size = os.path.getsize(local_file)
+        with self.session(host, username, password) as srv:
+            start = time.perf_counter()
+            srv.put(local_file)
+            elapsed = time.perf_counter() - start
+
+        transfer = {
+            "file": local_file,
+            "host": host,
+            "bytes": size,
+            "seconds": elapsed,
+            "bytes_per_second": size / elapsed if elapsed else 0,
+        }
+        report(transfer)
+        return transfer
+
+    # upload a list of (local_file, host, username, password) concurrently, returning each transfer's statistics
+    def upload_many(self, uploads):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.upload, *upload) for upload in uploads]
+            return [future.result() for future in futures]
+
+    # close every open connection
+    def close(self):
+        with self.sessions_lock:
+            for entry in self.sessions.values():
+                with entry[1]:
+                    if entry[0] is not None:
+                        self.discard(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# print a transfer's size, time and rate
+def report(transfer):
+    print(
+        "Uploaded {} to {}: {} bytes in {:.2f}s ({:.0f} bytes/s)".format(
+            os.path.basename(transfer["file"].replace("\\", "/")),
+            transfer["host"],
+            transfer["bytes"],
+            transfer["seconds"],
+            transfer["bytes_per_second"],
+        )
+    )
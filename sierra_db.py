@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+"""Shared pool of Sierra database connections for the report scripts
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Connections are opened once per config.ini section and handed back out to every
+query run in the same process, so a script that runs main('adfic') and then
+main('jfic') only pays for the connection handshake the first time.
+"""
+
+import atexit
+import hashlib
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errors
+
+import settings
+
+# pools are stored by config.ini section, as scripts use both [db] and [sql]
+_pools = {}
+_pools_lock = threading.Lock()
+
+# query templates already read from .sql files, keyed by file name
+_query_files = {}
+
+
+class SierraPool:
+    # keeps up to pool_max Sierra connections open between queries and hands them out to
+    # callers, who wait for a free connection instead of erroring once pool_max are checked out
+    def __init__(
+        self, connection_string, pool_min=1, pool_max=4, ping_after=60, profile=False
+    ):
+        self.connection_string = connection_string
+        self.slots = threading.BoundedSemaphore(pool_max)
+        self.ping_after = ping_after
+        # capture a query plan for every query run on this pool, see query_profiler.py
+        self.profile = profile
+        # open connections waiting to be handed out, the most recently returned last
+        self.idle = []
+        self.idle_lock = threading.Lock()
+        # time each connection was last returned to the pool, keyed by id()
+        self.last_used = {}
+        # names of the statements prepared on each connection, keyed by id()
+        self.prepared = {}
+        # pool_min connections are opened up front, the rest as they are needed
+        for i in range(pool_min):
+            self.idle.append(self.connect())
+
+    def connect(self):
+        return psycopg2.connect(self.connection_string)
+
+    # confirm a connection is still usable before handing it out
+    # connections that were idle for less than ping_after seconds are trusted
+    def healthy(self, conn):
+        if conn.closed:
+            return False
+        # connections that have never been handed out were just opened by the pool
+        last_used = self.last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.ping_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        self.slots.acquire()
+        try:
+            while True:
+                with self.idle_lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    return self.connect()
+                if self.healthy(conn):
+                    return conn
+                # replace stale connections (eg. dropped overnight by Sierra) with a fresh one
+                self.discard(conn)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            if conn.closed:
+                self.discard(conn)
+                return
+            try:
+                # end any open transaction so the next caller starts clean
+                conn.rollback()
+            except psycopg2.Error:
+                self.discard(conn)
+                return
+            self.last_used[id(conn)] = time.monotonic()
+            with self.idle_lock:
+                self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+    # close a connection, first dropping what is known about it so a later connection given
+    # the same id() does not inherit its prepared statements
+    def discard(self, conn):
+        self.last_used.pop(id(conn), None)
+        self.prepared.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def closeall(self):
+        with self.idle_lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self.discard(conn)
+
+
+# return the pool for a config.ini section, creating it on first use
+def get_pool(section="db"):
+    with _pools_lock:
+        if section not in _pools:
+            config = settings.load()
+            """
+            pool size can optionally be tuned in the same section as the connection string
+            [db]
+            connection_string = dbname='iii' user='username' host='hostname' password='password' port=1032
+            pool_min = 1
+            pool_max = 4
+            stream_batch_size = 2000
+            profile = false
+            """
+            try:
+                _pools[section] = SierraPool(
+                    config[section]["connection_string"],
+                    pool_min=config[section].getint("pool_min", 1),
+                    pool_max=config[section].getint("pool_max", 4),
+                    ping_after=config[section].getint("pool_ping_after", 60),
+                    profile=config[section].getboolean("profile", False),
+                )
+            except psycopg2.Error as e:
+                print("Unable to connect to database: " + str(e))
+                raise
+        return _pools[section]
+
+
+# open the pool_min connections ahead of time, so the first report does not wait on them
+def warm_up(section="db"):
+    get_pool(section)
+
+
+# when profiling is turned on for a section, save the query's plan before it is run for real
+def profile(query, params, section):
+    if get_pool(section).profile:
+        # imported here as query_profiler itself imports this module
+        import query_profiler
+
+        query_profiler.profile_query(query, params, section)
+
+
+# borrow a connection from the pool for the length of a with block
+@contextmanager
+def connection(section="db"):
+    pool = get_pool(section)
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+# execute a Sierra SQL query and return the results along with the column headers
+# params are passed through to psycopg2, eg. a list for location_code = ANY(%s)
+def run_query(query, section="db", params=None):
+    profile(query, params, section)
+    with connection(section) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        # Gather column headers, which are not included in the cursor.fetchall()
+        columns = [i[0] for i in cursor.description]
+        cursor.close()
+    return rows, columns
+
+
+# read a query template from a .sql file, caching it for later calls
+def load_query(sql_file):
+    if sql_file not in _query_files:
+        with open(sql_file, "r") as f:
+            _query_files[sql_file] = f.read()
+    return _query_files[sql_file]
+
+
+# convert %(name)s placeholders to the $1, $2... form used by PREPARE
+# returns the converted query and the parameter names in $ order
+def numbered_placeholders(query):
+    names = []
+
+    def placeholder(match):
+        name = match.group(1)
+        # %% is psycopg2's escape for a literal %
+        if name is None:
+            return "%"
+        if name not in names:
+            names.append(name)
+        return "$" + str(names.index(name) + 1)
+
+    return re.sub(r"%\((\w+)\)s|%%", placeholder, query.strip().rstrip(";")), names
+
+
+# execute a query with named %(name)s parameters as a server side prepared statement
+# the statement is prepared once per pooled connection and then reused by every later call
+# with the same query text, so repeated per-location runs skip parsing and planning
+def run_prepared(query, params=None, section="db"):
+    params = params or {}
+    profile(query, params, section)
+    statement = "report_" + hashlib.md5(query.encode("utf-8")).hexdigest()[:16]
+    prepare_sql, names = numbered_placeholders(query)
+    values = [params[name] for name in names]
+    execute_sql = "EXECUTE " + statement
+    if values:
+        execute_sql += " (" + ", ".join(["%s"] * len(values)) + ")"
+
+    pool = get_pool(section)
+    with connection(section) as conn:
+        prepared = pool.prepared.setdefault(id(conn), set())
+        cursor = conn.cursor()
+
+        def prepare():
+            try:
+                cursor.execute("PREPARE " + statement + " AS " + prepare_sql)
+            except psycopg2.errors.DuplicatePreparedStatement:
+                # already prepared on this session but not recorded, clear the failed transaction and reuse it
+                conn.rollback()
+            prepared.add(statement)
+
+        # prepared statements belong to the session, not the transaction, so a rollback does not remove them
+        # after an error, drop the statement from the session as well as our record of it, so the next call
+        # prepares it again from a clean state
+        def deallocate():
+            prepared.discard(statement)
+            try:
+                conn.rollback()
+                cursor.execute("DEALLOCATE " + statement)
+                conn.commit()
+            except psycopg2.Error:
+                # the statement was never created, or the connection itself has failed
+                if not conn.closed:
+                    conn.rollback()
+
+        try:
+            if statement not in prepared:
+                prepare()
+            try:
+                cursor.execute(execute_sql, values)
+            except psycopg2.errors.InvalidSqlStatementName:
+                # the session no longer has the statement (eg. after a DISCARD ALL), prepare it again
+                conn.rollback()
+                prepared.discard(statement)
+                prepare()
+                cursor.execute(execute_sql, values)
+            rows = cursor.fetchall()
+            columns = [i[0] for i in cursor.description]
+        except psycopg2.Error:
+            deallocate()
+            raise
+        finally:
+            cursor.close()
+    return rows, columns
+
+
+# execute a Sierra SQL query on a named server side cursor for the length of a with block
+# yields an iterator over the rows, fetched batch_size rows at a time, and the column headers
+# so large results can be written out row by row without holding the whole result in memory
+@contextmanager
+def stream_query(query, section="db", batch_size=None, params=None):
+    if batch_size is None:
+        config = settings.load()
+        batch_size = config[section].getint("stream_batch_size", 2000)
+    profile(query, params, section)
+
+    with connection(section) as conn:
+        # named cursors keep the result set on the Sierra side, each needs a unique name
+        cursor = conn.cursor(name="report_stream_" + uuid.uuid4().hex)
+        cursor.itersize = batch_size
+        # closed however the query or the caller fails, so the result set is not left open on Sierra
+        try:
+            cursor.execute(query, params)
+            # a named cursor has no description until the first batch has been fetched
+            first_batch = cursor.fetchmany(batch_size)
+            columns = [i[0] for i in cursor.description]
+
+            def rows():
+                batch = first_batch
+                while batch:
+                    yield from batch
+                    batch = cursor.fetchmany(batch_size)
+
+            yield rows(), columns
+        finally:
+            cursor.close()
+
+
+# have Sierra write the results of a query as csv using COPY ... TO STDOUT
+# output can be a file name or any writable binary file object, such as io.BytesIO
+# rows are never turned into Python objects, so this is much faster than fetchall() + csv.writer
+# COPY cannot take bind parameters, so any params are safely quoted into the query by psycopg2
+def copy_csv(query, output, section="db", header=True, params=None):
+    # COPY takes a bare query, so drop any trailing semicolon
+    query = query.strip().rstrip(";")
+    profile(query, params, section)
+    # closing parenthesis goes on its own line in case the query ends with a -- comment
+    copy_sql = "COPY (\n" + query + "\n) TO STDOUT WITH (FORMAT csv, HEADER {}, ENCODING 'UTF8')".format(
+        "true" if header else "false"
+    )
+
+    with connection(section) as conn:
+        cursor = conn.cursor()
+        if params:
+            copy_sql = cursor.mogrify(copy_sql, params).decode("utf-8")
+        if isinstance(output, str):
+            with open(output, "wb") as csvfile:
+                cursor.copy_expert(copy_sql, csvfile)
+        else:
+            cursor.copy_expert(copy_sql, output)
+        cursor.close()
+    return output
+
+
+# close every pooled connection, called automatically when the script exits
+def close_all():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
+atexit.register(close_all)
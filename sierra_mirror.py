@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""Local DuckDB mirror of the sierra_view tables used by the reports
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+The first sync copies the tables and columns listed in MIRROR_TABLES into a local DuckDB
+file. Later syncs use record_metadata's last updated and deletion dates to find the records
+that changed since the previous sync and only copy those rows again. Report queries can then
+be run against the mirror with run_query(), keeping heavy scans off of the production server.
+
+usage: python sierra_mirror.py    (run a sync)
+"""
+
+import os
+import re
+import tempfile
+
+import duckdb
+
+import settings
+import sierra_db
+
+"""
+tables and columns to mirror
+record_id is the column holding the record whose record_metadata dates mark the row as changed,
+tables without one are small enough to copy in full on every sync
+where limits the rows mirrored to those the reports actually use
+"""
+MIRROR_TABLES = {
+    "record_metadata": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("record_type_code", "VARCHAR"),
+            ("record_num", "INTEGER"),
+            ("creation_date_gmt", "TIMESTAMPTZ"),
+            ("record_last_updated_gmt", "TIMESTAMPTZ"),
+            ("deletion_date_gmt", "DATE"),
+        ],
+        "record_id": "id",
+        "where": "record_type_code IN ('b','i','o')",
+    },
+    "item_record": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("item_status_code", "VARCHAR"),
+            ("location_code", "VARCHAR"),
+        ],
+        "record_id": "id",
+    },
+    "item_view": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("record_num", "INTEGER"),
+            ("barcode", "VARCHAR"),
+            ("location_code", "VARCHAR"),
+            ("item_status_code", "VARCHAR"),
+            ("record_creation_date_gmt", "TIMESTAMPTZ"),
+        ],
+        "record_id": "id",
+    },
+    "bib_record_item_record_link": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("bib_record_id", "BIGINT"),
+            ("item_record_id", "BIGINT"),
+        ],
+        "record_id": "item_record_id",
+    },
+    "bib_record_order_record_link": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("bib_record_id", "BIGINT"),
+            ("order_record_id", "BIGINT"),
+        ],
+        "record_id": "order_record_id",
+    },
+    "order_record": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("order_status_code", "VARCHAR"),
+            ("accounting_unit_code_num", "INTEGER"),
+        ],
+        "record_id": "id",
+    },
+    "bib_record_property": {
+        "columns": [
+            ("bib_record_id", "BIGINT"),
+            ("best_title", "VARCHAR"),
+            ("best_author", "VARCHAR"),
+            ("material_code", "VARCHAR"),
+        ],
+        "record_id": "bib_record_id",
+    },
+    "phrase_entry": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("record_id", "BIGINT"),
+            ("index_tag", "VARCHAR"),
+            ("varfield_type_code", "VARCHAR"),
+            ("index_entry", "VARCHAR"),
+        ],
+        "record_id": "record_id",
+        "where": "index_tag IN ('c','t')",
+    },
+    "varfield": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("record_id", "BIGINT"),
+            ("varfield_type_code", "VARCHAR"),
+            ("field_content", "VARCHAR"),
+        ],
+        "record_id": "record_id",
+        "where": "varfield_type_code = 'v'",
+    },
+    "subfield": {
+        "columns": [
+            ("record_id", "BIGINT"),
+            ("marc_tag", "VARCHAR"),
+            ("tag", "VARCHAR"),
+            ("content", "VARCHAR"),
+        ],
+        "record_id": "record_id",
+        "where": "marc_tag IN ('001','020')",
+    },
+    "hold": {
+        "columns": [
+            ("id", "BIGINT"),
+            ("record_id", "BIGINT"),
+            ("placed_gmt", "TIMESTAMPTZ"),
+        ],
+        "record_id": None,
+    },
+}
+
+
+# location of the mirror database, set in the optional [mirror] section of config.ini
+def mirror_file():
+    config = settings.load()
+    """
+    [mirror]
+    database = sierra_mirror.duckdb
+    """
+    if "mirror" not in config:
+        return "sierra_mirror.duckdb"
+    return config["mirror"].get("database", "sierra_mirror.duckdb")
+
+
+# create the sierra_view schema, the mirrored tables and the table recording sync times
+def create_tables(mirror):
+    mirror.execute("CREATE SCHEMA IF NOT EXISTS sierra_view")
+    for table, spec in MIRROR_TABLES.items():
+        columns = ", ".join(name + " " + data_type for name, data_type in spec["columns"])
+        mirror.execute(
+            "CREATE TABLE IF NOT EXISTS sierra_view." + table + " (" + columns + ")"
+        )
+    mirror.execute(
+        "CREATE TABLE IF NOT EXISTS mirror_sync (table_name VARCHAR PRIMARY KEY, synced_gmt TIMESTAMPTZ)"
+    )
+
+
+# copy the results of a Sierra query into a DuckDB table with the given (name, type) columns
+# rows travel as csv through COPY TO STDOUT, which DuckDB can load far faster than row by row inserts
+def copy_rows(mirror, target, columns, query, params=None):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_file = os.path.join(temp_dir, "rows.csv")
+        sierra_db.copy_csv(query, csv_file, params=params)
+        column_types = ", ".join(
+            "'{}': '{}'".format(name, data_type) for name, data_type in columns
+        )
+        mirror.execute(
+            "INSERT INTO " + target
+            + " SELECT * FROM read_csv(?, header = true, columns = {" + column_types + "})",
+            [csv_file],
+        )
+
+
+# copy the results of a Sierra query into a mirrored table
+def load_rows(mirror, table, query, params=None):
+    copy_rows(mirror, "sierra_view." + table, MIRROR_TABLES[table]["columns"], query, params)
+
+
+# load the ids of records updated or deleted since a sync time into the changed_record table
+# returns the ids, which are then used for every table synced from that time
+def fetch_changed_records(mirror, since):
+    mirror.execute("CREATE OR REPLACE TEMP TABLE changed_record (id BIGINT)")
+    copy_rows(
+        mirror,
+        "changed_record",
+        [("id", "BIGINT")],
+        """
+        SELECT id FROM sierra_view.record_metadata
+        WHERE record_last_updated_gmt >= %(since)s
+          OR deletion_date_gmt >= %(since)s::DATE
+        """,
+        {"since": since},
+    )
+    return [row[0] for row in mirror.execute("SELECT id FROM changed_record").fetchall()]
+
+
+# bring a single table up to date, either in full or only for the changed records listed in changed_ids
+def sync_table(mirror, table, since, changed_ids=None):
+    spec = MIRROR_TABLES[table]
+    columns = ", ".join(name for name, data_type in spec["columns"])
+    query = "SELECT " + columns + " FROM sierra_view." + table + " WHERE " + spec.get("where", "TRUE")
+
+    if since is None or spec["record_id"] is None:
+        mirror.execute("DELETE FROM sierra_view." + table)
+        load_rows(mirror, table, query)
+        return
+    if not changed_ids:
+        return
+
+    # changed_ids were also loaded into the changed_record table by sync()
+    mirror.execute(
+        "DELETE FROM sierra_view." + table
+        + " WHERE " + spec["record_id"] + " IN (SELECT id FROM changed_record)"
+    )
+    # the same list is sent back to Sierra, so every table is reloaded for exactly the records deleted above
+    query += "\n      AND " + spec["record_id"] + " = ANY(%(ids)s::BIGINT[])"
+    load_rows(mirror, table, query, {"ids": changed_ids})
+
+
+# refresh every mirrored table, copying only records changed since each table's previous sync
+def sync():
+    # use Sierra's clock for the new sync time, taken before any rows are copied so nothing is missed
+    rows, columns = sierra_db.run_query("SELECT NOW()")
+    sync_started = rows[0][0]
+
+    mirror = duckdb.connect(mirror_file())
+    create_tables(mirror)
+    # tables are normally synced together, so the list of changed records is only fetched once per sync time
+    changed_since, changed_ids = None, None
+    for table in MIRROR_TABLES:
+        synced = mirror.execute(
+            "SELECT synced_gmt FROM mirror_sync WHERE table_name = ?", [table]
+        ).fetchone()
+        since = synced[0] if synced else None
+
+        mirror.execute("BEGIN TRANSACTION")
+        if since is not None and since != changed_since:
+            changed_since = since
+            changed_ids = fetch_changed_records(mirror, since)
+        sync_table(mirror, table, since, changed_ids)
+        mirror.execute(
+            "INSERT OR REPLACE INTO mirror_sync VALUES (?, ?)", [table, sync_started]
+        )
+        mirror.execute("COMMIT")
+        print("synced sierra_view." + table)
+    mirror.close()
+
+
+# rewrite the few Postgres expressions used by the reports that DuckDB reads differently
+def translate_query(query):
+    # ~ is a partial regular expression match in Postgres, but a full match in DuckDB
+    query = re.sub(
+        r"([\w.]+)\s*~\s*('(?:[^']|'')*')", r"regexp_matches(\1, \2)", query
+    )
+    # SUBSTRING(x FROM 'pattern') extracts a regular expression match in Postgres, or NULL if there is none
+    query = re.sub(
+        r"SUBSTRING\(\s*([\w.]+)\s+FROM\s+('(?:[^']|'')*')\s*\)",
+        r"NULLIF(regexp_extract(\1, \2), '')",
+        query,
+        flags=re.IGNORECASE,
+    )
+    return query
+
+
+# run a report query against the mirror instead of Sierra, returning the results and column headers
+# params use the same %(name)s placeholders as sierra_db.run_prepared()
+def run_query(query, params=None):
+    params = params or {}
+    mirror_query, names = sierra_db.numbered_placeholders(translate_query(query))
+    mirror = duckdb.connect(mirror_file(), read_only=True)
+    try:
+        cursor = mirror.execute(mirror_query, [params[name] for name in names])
+        rows = cursor.fetchall()
+        columns = [i[0] for i in cursor.description]
+    finally:
+        mirror.close()
+    return rows, columns
+
+
+if __name__ == "__main__":
+    sync()
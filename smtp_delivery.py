@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""Send many emails over a small pool of SMTP sessions
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+DeliveryEngine opens a few SMTP sessions, each running EHLO, STARTTLS and LOGIN once, and
+sends many messages over each of them concurrently rather than connecting for every email.
+A shared rate limit keeps the total sending rate under what the mail server allows, and the
+number of messages sent per second is printed when delivery finishes. Settings come from the
+[email] section of config.ini:
+
+[email]
+host = smtp-relay.gmail.com
+port = 587
+user = useraccount
+pw = password
+sender = jgoldstein@minlib.net
+starttls = true              (optional, default true)
+smtp_sessions = 4            (optional, default 4)
+smtp_rate = 10               (optional, most messages per second across all sessions, default no limit)
+smtp_messages_per_session = 100  (optional, messages sent before a session is reopened, default 100)
+smtp_timeout = 60            (optional, seconds to wait on the server before giving up, default 60)
+
+If a session cannot be opened, because the server refuses or does not answer the connection or
+rejects the login, delivery stops and the error is raised. Messages not yet sent are left alone
+rather than reported as failed.
+
+With starttls = false and no user, messages can be sent to a local SMTP sink for testing,
+such as python -m aiosmtpd -n -l localhost:1025.
+"""
+
+import queue
+import smtplib
+import threading
+import time
+
+import settings
+
+# how many times a message is retried on a fresh session after the session fails
+SESSION_RETRIES = 2
+
+
+# read the [email] settings used to open sessions
+def email_settings(section="email"):
+    config = settings.load()
+    email = config[section]
+    return {
+        "host": email["host"],
+        "port": email.getint("port", 25),
+        "user": email.get("user", ""),
+        "pw": email.get("pw", ""),
+        "sender": email.get("sender", ""),
+        "starttls": email.getboolean("starttls", True),
+        "sessions": email.getint("smtp_sessions", 4),
+        "rate": email.getfloat("smtp_rate", 0),
+        "messages_per_session": email.getint("smtp_messages_per_session", 100),
+        "timeout": email.getfloat("smtp_timeout", 60),
+    }
+
+
+# spaces sends out so that no more than rate messages per second are sent across all threads
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_send = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            send_at = max(now, self.next_send)
+            self.next_send = send_at + self.interval
+        if send_at > now:
+            time.sleep(send_at - now)
+
+
+class DeliveryEngine:
+    def __init__(self, settings=None):
+        if settings is None:
+            settings = email_settings()
+        self.settings = settings
+        self.limiter = RateLimiter(settings["rate"])
+
+    # open an authenticated SMTP session
+    def connect(self):
+        smtp = smtplib.SMTP(self.settings["host"], self.settings["port"], timeout=self.settings["timeout"])
+        smtp.ehlo()
+        if self.settings["starttls"]:
+            smtp.starttls()
+            smtp.ehlo()
+        if self.settings["user"]:
+            smtp.login(self.settings["user"], self.settings["pw"])
+        return smtp
+
+    # close a session, ignoring errors from one that has already dropped
+    def disconnect(self, smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    # send (key, recipients, msg) tuples from an iterable concurrently over the session pool
+    # msg is an email message object, and key is any value identifying it, such as a patron id
+    # on_sent(key) and on_failed(key, error) are called from the sending threads as each message finishes
+    # returns the number of messages sent and failed
+    def deliver(self, messages, on_sent=None, on_failed=None):
+        # a bounded queue, so messages can be produced as they are sent
+        pending = queue.Queue(maxsize=self.settings["sessions"] * 10)
+        counts = {"sent": 0, "failed": 0}
+        counts_lock = threading.Lock()
+        errors = []
+        # set when a session hits an error that stops delivery, such as an unreachable server or a rejected login
+        stopping = threading.Event()
+
+        def finish(outcome, key, error=None):
+            with counts_lock:
+                counts[outcome] += 1
+            if outcome == "sent" and on_sent:
+                on_sent(key)
+            elif outcome == "failed" and on_failed:
+                on_failed(key, error)
+
+        def worker():
+            try:
+                send_loop()
+            except Exception as e:
+                errors.append(e)
+                stopping.set()
+                # keep taking messages so the producer is not left waiting on a full queue
+                while pending.get() is not None:
+                    pass
+
+        def send_loop():
+            smtp = None
+            session_count = 0
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                # once delivery is stopping, take what is left off the queue without sending it
+                if stopping.is_set():
+                    continue
+                key, recipients, msg = item
+                for attempt in range(SESSION_RETRIES + 1):
+                    # opening a session is left outside the try, so a server that cannot be reached, times out
+                    # or rejects the login stops delivery and leaves the messages unsent rather than failed
+                    if smtp is None or session_count >= self.settings["messages_per_session"]:
+                        if smtp is not None:
+                            self.disconnect(smtp)
+                        smtp = None
+                        smtp = self.connect()
+                        session_count = 0
+                    try:
+                        self.limiter.wait()
+                        smtp.sendmail(self.settings["sender"] or msg["From"], recipients, msg.as_string())
+                        session_count += 1
+                        finish("sent", key)
+                        break
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                        # the message was refused, the session is still usable
+                        session_count += 1
+                        finish("failed", key, e)
+                        break
+                    except (smtplib.SMTPException, OSError) as e:
+                        # the session failed, retry the message on a new one
+                        smtp.close()
+                        smtp = None
+                        if attempt == SESSION_RETRIES:
+                            finish("failed", key, e)
+            if smtp is not None:
+                self.disconnect(smtp)
+
+        threads = [
+            threading.Thread(target=worker)
+            for i in range(self.settings["sessions"])
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for message in messages:
+                if stopping.is_set():
+                    break
+                pending.put(message)
+        finally:
+            # one stop marker per session, then wait for the queue to drain
+            for thread in threads:
+                pending.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+        elapsed = time.perf_counter() - start
+        print(
+            "Sent {} messages in {:.1f}s ({:.1f} messages/s), {} failed".format(
+                counts["sent"],
+                elapsed,
+                counts["sent"] / elapsed if elapsed else 0,
+                counts["failed"],
+            )
+        )
+        return counts["sent"], counts["failed"]
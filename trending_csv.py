@@ -7,61 +7,47 @@ Modification to script originally written by Gem Stone-Logan
 Contact Info: jgoldstein@minlib.net
 """
 
-import psycopg2
+import sierra_db
+import report_artifacts
 import csv
-import configparser
+import settings
 import smtplib
-import os
 from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import formatdate
-from email import encoders
 
 # execute a Sierra SQL query and return the results
 def run_query(query):
-    # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    # Connecting to Sierra PostgreSQL database
-    try:
-        conn = psycopg2.connect(config["db"]["connection_string"])
-    except psycopg2.Error as e:
-        print("Unable to connect to database: " + str(e))
-
-    # Opening a session and querying the database
-    cursor = conn.cursor()
-    cursor.execute(query)
-    # For now, just storing the data in a variable. We'll use it later.
-    rows = cursor.fetchall()
-    # Gather column headers, which are not included in the cursor.fetchall() 
-    columns = [i[0] for i in cursor.description]
-    conn.close()
+    # borrow a connection from the shared Sierra pool rather than opening a new one
+    with sierra_db.connection("db") as conn:
+        # Opening a session and querying the database
+        cursor = conn.cursor()
+        cursor.execute(query)
+        # For now, just storing the data in a variable. We'll use it later.
+        rows = cursor.fetchall()
+        # Gather column headers, which are not included in the cursor.fetchall() 
+        columns = [i[0] for i in cursor.description]
     return rows, columns
 
 
 #takes results of a sql query and a list of the results column headers and write them to a .csv file
 def write_csv(query_results, headers):
     
-    csvfile = "WeeklyNewItem.csv"
+    csvfile = report_artifacts.new_artifact()
     
-    #open file in write mode and write all rows from query results to the file
-    #set encoding to utf-8 to match Sierra characters and newline to '' to avoid excess line breaks
-    with open(csvfile,'w', encoding='utf-8', newline='') as tempFile:
+    #write all rows from query results to the artifact as utf-8 to match Sierra characters
+    with report_artifacts.text_writer(csvfile) as tempFile:
         myFile = csv.writer(tempFile, delimiter=',')
         #write header row then write full query results
         myFile.writerow(headers)
         myFile.writerows(query_results)
-    tempFile.close()
     
     return csvfile
 
-#Send an email with an attachment passed to the function
-def send_email(attachment, subject, message, recipient):
+#Send an email with an attachment passed to the function, filename is the name it is attached as
+def send_email(attachment, filename, subject, message, recipient):
     # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
+    config = settings.load()
 
     # These are variables for the email that will be sent.
     # Make sure to use your own library's email server (emailhost)
@@ -84,11 +70,8 @@ def send_email(attachment, subject, message, recipient):
     msg["Date"] = formatdate(localtime=True)
     msg["Subject"] = subject
     msg.attach(MIMEText(message))
-    part = MIMEBase("application", "octet-stream")
-    part.set_payload(open(attachment, "rb").read())
-    encoders.encode_base64(part)
-    part.add_header("Content-Disposition", "attachment; filename=%s" % attachment)
-    msg.attach(part)
+    # attach the report straight from memory, zipped if it is large
+    msg.attach(report_artifacts.attachment_part(attachment, filename))
 
     # Sending the email message
     smtp = smtplib.SMTP(emailhost, emailport)
@@ -100,7 +83,8 @@ def send_email(attachment, subject, message, recipient):
     smtp.quit()
 
 
-def main():
+#copy=True has Sierra write the csv directly with COPY TO STDOUT instead of fetching rows into Python
+def main(copy=False):
     query = """
       /*
       Jeremy Goldstein
@@ -165,12 +149,15 @@ def main():
     """
     emailto = ["jgoldstein@minlib.net"]
     
-    query_results, headers = run_query(query)
-    local_file = write_csv(query_results, headers)
-    send_email(local_file, email_subject, email_message, emailto)
+    if copy:
+        local_file = sierra_db.copy_csv(query, report_artifacts.new_artifact())
+    else:
+        query_results, headers = run_query(query)
+        local_file = write_csv(query_results, headers)
+    send_email(local_file, "WeeklyNewItem.csv", email_subject, email_message, emailto)
     
-    #delete local_file
-    os.remove(local_file)
+    #close the artifact, discarding any temporary file behind it
+    local_file.close()
 
 
-main()
+main(copy=True)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""Create and email a list of trending titles from locally stored daily hold counts
+
+Author: Jeremy Goldstein
+Contact Info: jgoldstein@minlib.net
+
+Holds placed on each bib are counted per day and saved to a local SQLite store. Each run
+only asks Sierra for the holds placed on the most recently stored day and after, so the
+trending list for any rolling window (7, 14 or 30 days) comes from the stored counts rather
+than rescanning the whole hold table. Item level holds are resolved to their bib with a join
+instead of a subquery per hold.
+
+Because days are counted when they are ingested, holds that were later filled or cancelled
+still count towards the day they were placed.
+
+usage: python trending_incremental.py [window_days] [top_n]
+"""
+
+import sierra_db
+import report_artifacts
+import sqlite3
+import csv
+import settings
+import smtplib
+import sys
+from datetime import date, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+# days of hold counts kept in the store, the longest window that can be reported on
+KEEP_DAYS = 30
+
+# open the local store of daily hold counts, creating its table on first use
+def open_store(store_file="trending_store.db"):
+    store = sqlite3.connect(store_file)
+    store.execute(
+        """
+        CREATE TABLE IF NOT EXISTS hold_day (
+          bib_record_id INTEGER,
+          placed_date TEXT,
+          holds INTEGER,
+          PRIMARY KEY (bib_record_id, placed_date)
+        )"""
+    )
+    return store
+
+# count the holds placed per bib for each day from the newest stored day onward and save them
+# the newest stored day is counted again as it may have been stored before the day was over
+def ingest_holds(store):
+    row = store.execute("SELECT MAX(placed_date) FROM hold_day").fetchone()
+    oldest_kept = date.today() - timedelta(days=KEEP_DAYS - 1)
+    since = max(date.fromisoformat(row[0]), oldest_kept) if row[0] else oldest_kept
+
+    query = """
+      SELECT
+        t.bib_record_id,
+        t.placed_date,
+        COUNT(*) AS holds
+      FROM (
+        SELECT
+          h.placed_gmt::DATE AS placed_date,
+          CASE
+            WHEN r.record_type_code = 'b' THEN h.record_id
+            -- an item can be linked to more than one bib, count the hold once
+            ELSE MIN(l.bib_record_id)
+          END AS bib_record_id
+        FROM sierra_view.hold h
+        JOIN sierra_view.record_metadata r
+          ON r.id = h.record_id
+          AND r.record_type_code IN ('b','i')
+        LEFT JOIN sierra_view.bib_record_item_record_link l
+          ON r.record_type_code = 'i'
+          AND l.item_record_id = h.record_id
+        WHERE h.placed_gmt >= %(since)s::DATE
+        GROUP BY h.id, h.placed_gmt, r.record_type_code, h.record_id
+      ) t
+      WHERE t.bib_record_id IS NOT NULL
+      GROUP BY 1, 2
+    """
+    rows, columns = sierra_db.run_prepared(query, {"since": since})
+
+    store.execute("DELETE FROM hold_day WHERE placed_date >= ?", (since.isoformat(),))
+    store.executemany(
+        "INSERT OR REPLACE INTO hold_day VALUES (?, ?, ?)",
+        [(row[0], row[1].isoformat(), row[2]) for row in rows],
+    )
+    # drop days that are older than any window that can be reported on
+    store.execute("DELETE FROM hold_day WHERE placed_date < ?", (oldest_kept.isoformat(),))
+    store.commit()
+
+# return the top titles by holds placed in the last window_days days, in the trending_csv.py layout
+# as in trending_csv.py, only titles with more than one hold in the window are included
+# bibs that Sierra no longer has details for are skipped, so titles are looked up a page at a time until top_n are found
+def top_titles(store, window_days=7, top_n=50):
+    window_start = date.today() - timedelta(days=window_days - 1)
+    holds_count = store.execute(
+        """
+        SELECT bib_record_id, SUM(holds) AS holds_on_title
+        FROM hold_day
+        WHERE placed_date >= ?
+        GROUP BY bib_record_id
+        HAVING SUM(holds) > 1
+        ORDER BY holds_on_title DESC""",
+        (window_start.isoformat(),),
+    )
+
+    # look up bib details for just the top titles
+    query = """
+      SELECT
+        rm.id,
+        rm.record_type_code||rm.record_num||'a' AS bib_number,
+        b.best_title AS title,
+        b.best_author AS author
+      FROM sierra_view.record_metadata rm
+      JOIN sierra_view.bib_record_property b
+        ON rm.id = b.bib_record_id
+      WHERE rm.id = ANY(%(bibs)s::BIGINT[])
+    """
+    titles = []
+    while len(titles) < top_n:
+        page = holds_count.fetchmany(top_n * 2)
+        if not page:
+            break
+        rows, columns = sierra_db.run_prepared(
+            query, {"bibs": [bib_record_id for bib_record_id, holds in page]}
+        )
+        bibs = {row[0]: row[1:] for row in rows}
+        titles += [
+            bibs[bib_record_id] + (holds,)
+            for bib_record_id, holds in page
+            if bib_record_id in bibs
+        ]
+
+    return [(rank,) + title for rank, title in enumerate(titles[:top_n], start=1)]
+
+#takes results of a sql query and a list of the results column headers and write them to a .csv file
+def write_csv(query_results, headers):
+
+    csvfile = report_artifacts.new_artifact()
+
+    #write all rows from query results to the artifact as utf-8 to match Sierra characters
+    with report_artifacts.text_writer(csvfile) as tempFile:
+        myFile = csv.writer(tempFile, delimiter=',')
+        #write header row then write full query results
+        myFile.writerow(headers)
+        myFile.writerows(query_results)
+
+    return csvfile
+
+#Send an email with an attachment passed to the function, filename is the name it is attached as
+def send_email(attachment, filename, subject, message, recipient):
+    # read config file with Sierra login credentials
+    config = settings.load()
+
+    # These are variables for the email that will be sent.
+    # Make sure to use your own library's email server (emailhost)
+    emailhost = config["email"]["host"]
+    # user and pw was not in the original script, necessary for Minuteman's Gmail accounts
+    emailuser = config["email"]["user"]
+    emailpass = config["email"]["pw"]
+    emailport = "25"
+
+    # Enter your own email information
+    emailfrom = "jgoldstein@minlib.net"
+
+    # Creating the email message
+    msg = MIMEMultipart()
+    msg["From"] = emailfrom
+    if type(recipient) is list:
+        msg["To"] = ", ".join(recipient)
+    else:
+        msg["To"] = recipient
+    msg["Date"] = formatdate(localtime=True)
+    msg["Subject"] = subject
+    msg.attach(MIMEText(message))
+    # attach the report straight from memory, zipped if it is large
+    msg.attach(report_artifacts.attachment_part(attachment, filename))
+
+    # Sending the email message
+    smtp = smtplib.SMTP(emailhost, emailport)
+    # for Gmail connection used within Minuteman
+    smtp.ehlo()
+    smtp.starttls()
+    smtp.login(emailuser, emailpass)
+    smtp.sendmail(emailfrom, recipient, msg.as_string())
+    smtp.quit()
+
+
+def main(window_days=7, top_n=50):
+    email_subject = "Trending titles, last {} days".format(window_days)
+    email_message = """***This is an automated email***
+
+    The trending titles report has been attached.
+    Please take a look and let the Technology Librarian know if there are any questions about it.
+    """
+    emailto = ["jgoldstein@minlib.net"]
+    headers = ["rank", "bib_number", "title", "author", "holds_on_title"]
+
+    store = open_store()
+    ingest_holds(store)
+    query_results = top_titles(store, window_days, top_n)
+    store.close()
+
+    local_file = write_csv(query_results, headers)
+    send_email(local_file, "TrendingTitles.csv", email_subject, email_message, emailto)
+
+    #close the artifact, discarding any temporary file behind it
+    local_file.close()
+
+
+main(*[int(arg) for arg in sys.argv[1:3]])
@@ -7,44 +7,29 @@ Modification to script originally written by Gem Stone-Logan
 Contact Info: jgoldstein@minlib.net
 """
 
-import psycopg2
+import sierra_db
+import report_artifacts
 import xlsxwriter
-import configparser
+import settings
 import smtplib
-import os
 from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import formatdate
-from email import encoders
 
-# execute a Sierra SQL query and return the results
+# execute the Sierra SQL query stored in a .sql file and return the results
 def run_query(query):
-    # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    # Connecting to Sierra PostgreSQL database
-    try:
-        conn = psycopg2.connect(config["db"]["connection_string"])
-    except psycopg2.Error as e:
-        print("Unable to connect to database: " + str(e))
-
-    # Opening a session and querying the database
-    cursor = conn.cursor()
-    cursor.execute(open(query, "r").read())
-    # For now, just storing the data in a variable. We'll use it later.
-    rows = cursor.fetchall()
-    conn.close()
+    # run as a prepared statement on a pooled connection, so repeat runs skip re-planning
+    rows, columns = sierra_db.run_prepared(sierra_db.load_query(query))
     return rows
 
 #take a set of results from a sql query and write them to an Excel file, returning the file
-def write_excel(query_results):
-    # Name of Excel File
-    excel_file = "WeeklyNewItem.xlsx"
+#constant_memory flushes each row to disk as it is written, for use with streamed query results
+def write_excel(query_results, constant_memory=False):
+    # Excel file is built in memory, spilling to a temporary file if it grows large
+    excel_file = report_artifacts.new_artifact()
     
     # Creating the Excel file for staff
-    workbook = xlsxwriter.Workbook(excel_file)
+    workbook = xlsxwriter.Workbook(excel_file, {"constant_memory": constant_memory})
     worksheet = workbook.add_worksheet()
 
     # Formatting our Excel worksheet
@@ -57,52 +42,42 @@ def write_excel(query_results):
         {"text_wrap": True, "valign": "top", "bold": True}
     )
 
-    # Setting the column widths
-    worksheet.set_column("A:A", 10.29)
-    worksheet.set_column("B:B", 6.29)
-    worksheet.set_column("C:C", 12.71)
-    worksheet.set_column("D:D", 16.57)
-    worksheet.set_column("E:E", 24.71)
-    worksheet.set_column("F:F", 11.14)
-    worksheet.set_column("G:G", 18.47)
-    worksheet.set_column("H:J", 4.5)
+    # Setting the column widths, along with the format for every cell in the column
+    worksheet.set_column("A:A", 10.29, eformat)
+    worksheet.set_column("B:B", 6.29, eformat)
+    worksheet.set_column("C:C", 12.71, eformat)
+    worksheet.set_column("D:D", 16.57, eformat)
+    worksheet.set_column("E:E", 24.71, eformat)
+    worksheet.set_column("F:F", 11.14, eformat)
+    worksheet.set_column("G:G", 18.47, eformat)
+    worksheet.set_column("H:J", 4.5, eformat)
 
     # Inserting a header
     worksheet.set_header("&CWeekly New List")
 
     # Adding column labels
-    worksheet.write("A1", "Bib Record#", eformatlabel)
-    worksheet.write("B1", "Location", eformatlabel)
-    worksheet.write("C1", "Call#", eformatlabel)
-    worksheet.write("D1", "Author", eformatlabel)
-    worksheet.write("E1", "Title", eformatlabel)
-    worksheet.write("F1", "Barcode", eformatlabel)
-    worksheet.write("G1", "Series", eformatlabel)
-    worksheet.write("H1", "Item Count", eformatlabel)
-    worksheet.write("I1", "Order Count", eformatlabel)
-    worksheet.write("J1", "Hold Count", eformatlabel)
-
-    # Writing the report for staff to the Excel worksheet
-    for rownum, row in enumerate(query_results):
-        worksheet.write(rownum + 1, 0, row[0], eformat)
-        worksheet.write(rownum + 1, 1, row[1], eformat)
-        worksheet.write(rownum + 1, 2, row[2], eformat)
-        worksheet.write(rownum + 1, 3, row[3], eformat)
-        worksheet.write(rownum + 1, 4, row[4], eformat)
-        worksheet.write(rownum + 1, 5, row[5], eformat)
-        worksheet.write(rownum + 1, 6, row[6], eformat)
-        worksheet.write(rownum + 1, 7, row[7], eformat)
-        worksheet.write(rownum + 1, 8, row[8], eformat)
-        worksheet.write(rownum + 1, 9, row[9], eformat)
+    worksheet.write_row(
+        0,
+        0,
+        [
+            "Bib Record#", "Location", "Call#", "Author", "Title",
+            "Barcode", "Series", "Item Count", "Order Count", "Hold Count",
+        ],
+        eformatlabel,
+    )
+
+    # Writing the report for staff to the Excel worksheet a whole row at a time
+    # cells pick up eformat from their column rather than being formatted one by one
+    for rownum, row in enumerate(query_results, start=1):
+        worksheet.write_row(rownum, 0, row)
 
     workbook.close()
     return excel_file
 
-#Send an email with an attachment passed to the function
-def send_email(attachment):
+#Send an email with an attachment passed to the function, filename is the name it is attached as
+def send_email(attachment, filename):
     # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
+    config = settings.load()
 
     # These are variables for the email that will be sent.
     # Make sure to use your own library's email server (emailhost)
@@ -131,11 +106,8 @@ def send_email(attachment):
     msg["Date"] = formatdate(localtime=True)
     msg["Subject"] = emailsubject
     msg.attach(MIMEText(emailmessage))
-    part = MIMEBase("application", "octet-stream")
-    part.set_payload(open(attachment, "rb").read())
-    encoders.encode_base64(part)
-    part.add_header("Content-Disposition", "attachment; filename=%s" % attachment)
-    msg.attach(part)
+    # attach the report straight from memory, zipped if it is large
+    msg.attach(report_artifacts.attachment_part(attachment, filename))
 
     # Sending the email message
     smtp = smtplib.SMTP(emailhost, emailport)
@@ -147,14 +119,21 @@ def send_email(attachment):
     smtp.quit()
 
 
-def main():
+#stream=True fetches rows from a server side cursor in batches and writes them as they arrive
+def main(stream=False):
     query = "WeeklyNewItemsRev.sql"
     
-    query_results = run_query(query)
-    local_file = write_excel(query_results)
-    send_email(local_file)
+    if stream:
+        with sierra_db.stream_query(sierra_db.load_query(query)) as (query_results, headers):
+            local_file = write_excel(query_results, constant_memory=True)
+    else:
+        query_results = run_query(query)
+        local_file = write_excel(query_results)
+    send_email(local_file, "WeeklyNewItem.xlsx")
     
-    os.remove(local_file)
+    #close the artifact, discarding any temporary file behind it
+    local_file.close()
 
 
-main()
+#query has no location filter, so stream the results to keep memory use flat
+main(stream=True)
@@ -7,56 +7,42 @@ Modification to script originally written by Gem Stone-Logan
 Contact Info: jgoldstein@minlib.net
 """
 
-import psycopg2
+import sierra_db
+import report_artifacts
+import result_cache
 import csv
-import configparser
+import settings
 import smtplib
-import os
+import sys
 from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import formatdate
-from email import encoders
 
-# execute a Sierra SQL query and return the results
-def run_query(query):
-    # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
-
-    # Connecting to Sierra PostgreSQL database
-    try:
-        conn = psycopg2.connect(config["db"]["connection_string"])
-    except psycopg2.Error as e:
-        print("Unable to connect to database: " + str(e))
-
-    # Opening a session and querying the database
-    cursor = conn.cursor()
-    cursor.execute(query)
-    # For now, just storing the data in a variable. We'll use it later.
-    rows = cursor.fetchall()
-    conn.close()
+# execute a Sierra SQL query with named parameters and return the results
+#results are saved to a local cache, and resend=True rebuilds the report from those saved results
+def run_query(query, params=None, resend=False):
+    # run as a prepared statement on a pooled connection, so repeat calls with a new location skip re-planning
+    rows, columns = result_cache.cached_query(
+        query, params, window=result_cache.week_window(), refresh=not resend
+    )
     return rows
 
 #takes results of a sql query and write them to a .csv file
 def write_csv(query_results):
     
-    csvfile = "WeeklyNewItem.csv"
+    csvfile = report_artifacts.new_artifact()
     
-    #open file in write mode and write all rows from query results to the file
-    #set encoding to utf-8 to match Sierra characters and newline to '' to avoid excess line breaks
-    with open(csvfile,'w', encoding='utf-8', newline='') as tempFile:
+    #write all rows from query results to the artifact as utf-8 to match Sierra characters
+    with report_artifacts.text_writer(csvfile) as tempFile:
         myFile = csv.writer(tempFile, delimiter=',')
         myFile.writerows(query_results)
-    tempFile.close()
     
     return csvfile
 
-#Send an email with an attachment passed to the function
-def send_email(attachment):
+#Send an email with an attachment passed to the function, filename is the name it is attached as
+def send_email(attachment, filename):
     # read config file with Sierra login credentials
-    config = configparser.ConfigParser()
-    config.read("config.ini")
+    config = settings.load()
 
     # These are variables for the email that will be sent.
     # Make sure to use your own library's email server (emailhost)
@@ -85,11 +71,8 @@ def send_email(attachment):
     msg["Date"] = formatdate(localtime=True)
     msg["Subject"] = emailsubject
     msg.attach(MIMEText(emailmessage))
-    part = MIMEBase("application", "octet-stream")
-    part.set_payload(open(attachment, "rb").read())
-    encoders.encode_base64(part)
-    part.add_header("Content-Disposition", "attachment; filename=%s" % attachment)
-    msg.attach(part)
+    # attach the report straight from memory, zipped if it is large
+    msg.attach(report_artifacts.attachment_part(attachment, filename))
 
     # Sending the email message
     smtp = smtplib.SMTP(emailhost, emailport)
@@ -101,7 +84,7 @@ def send_email(attachment):
     smtp.quit()
 
 
-def main(location):
+def main(location, resend=False):
     query = """
       /* Weekly New Report
       The report will retrieve all items, not in the specifically excluded statuses
@@ -154,18 +137,25 @@ def main(location):
         AND o.order_status_code ='o'
 
       WHERE i.record_creation_date_gmt::date>=NOW()::DATE-EXTRACT(DOW FROM NOW())::INTEGER-10 
-        AND i.location_code = '""" + location + """'  
+        AND i.location_code = %(location)s
       GROUP BY rmb.record_num, i.location_code, "Call#", brp.best_author, brp.best_title
       ORDER BY i.location_code, "Call#", brp.best_author, brp.best_title
     """
     
-    query_results = run_query(query)
+    query_results = run_query(query, {"location": location}, resend)
     local_file = write_csv(query_results)
-    send_email(local_file)
+    send_email(local_file, "WeeklyNewItem.csv")
     
-    #delete local_file
-    os.remove(local_file)
+    #close the artifact, discarding any temporary file behind it
+    local_file.close()
+
+#run with --resend to email the reports again from the saved results, without querying Sierra
+resend = "--resend" in sys.argv
+
+#open the pooled Sierra connection once, then reuse it for each location
+if not resend:
+    sierra_db.warm_up()
 
 #call main function, passing different item locations that will feed into sql query
-main('adfic')
-main('jfic')
+main('adfic', resend)
+main('jfic', resend)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+"""Create and email a list of new items, fetching only items created since the last run
+
+Author: Jeremy Goldstein
+Modification to script originally written by Gem Stone-Logan
+Contact Info: jgoldstein@minlib.net
+
+Items are saved to a local SQLite store along with a watermark of the newest creation
+date already fetched. Each run only asks Sierra for items created since that watermark,
+then builds the rolling 10 day report from the store. Items already in the store are read
+again by id on each run, so later edits to their title, author, call number, barcode or status
+are picked up, and items that were deleted or moved to another location are dropped. Counts of
+orders and holds change after an item is created, so those are looked up fresh for just the
+bibs in the report. An item created elsewhere and moved into the location during the window is
+not picked up, as it was never fetched for this location.
+"""
+
+import sierra_db
+import report_artifacts
+import sqlite3
+import csv
+import settings
+import smtplib
+from datetime import date, timedelta, timezone
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+# item statuses that are excluded from the Item Count column
+EXCLUDED_STATUSES = ("m", "n", "z", "t", "s", "$", "d", "8", "w", "y")
+
+# open the local store of new items, creating its tables on first use
+def open_store(store_file="weeklynew_store.db"):
+    store = sqlite3.connect(store_file)
+    store.execute(
+        """
+        CREATE TABLE IF NOT EXISTS new_item (
+          item_id INTEGER,
+          call_number TEXT,
+          bib_record_id INTEGER,
+          bib_record_num TEXT,
+          location_code TEXT,
+          author TEXT,
+          title TEXT,
+          barcode TEXT,
+          item_status_code TEXT,
+          created_gmt TEXT,
+          created_date TEXT,
+          PRIMARY KEY (item_id, call_number)
+        )"""
+    )
+    store.execute(
+        "CREATE TABLE IF NOT EXISTS watermark (report TEXT PRIMARY KEY, last_created_gmt TEXT)"
+    )
+    return store
+
+# first day of the report window, matching NOW()::DATE-EXTRACT(DOW FROM NOW())::INTEGER-10
+def window_start():
+    today = date.today()
+    return today - timedelta(days=today.isoweekday() % 7 + 10)
+
+# item level columns saved in the store, followed by a WHERE clause
+ITEM_QUERY = """
+  SELECT
+    i.id,
+    UPPER(peb.index_entry),
+    bri.bib_record_id,
+    'b'|| rmb.record_num || 'a',
+    i.location_code,
+    brp.best_author,
+    brp.best_title,
+    i.barcode,
+    i.item_status_code,
+    i.record_creation_date_gmt,
+    i.record_creation_date_gmt::date
+  FROM sierra_view.item_view i
+  JOIN sierra_view.bib_record_item_record_link bri
+    ON i.id = bri.item_record_id
+  JOIN sierra_view.record_metadata rmb
+    ON bri.bib_record_id = rmb.id
+    AND rmb.record_type_code='b'
+  JOIN sierra_view.phrase_entry peb
+    ON i.id = peb.record_id
+    AND peb.index_tag='c'
+  JOIN sierra_view.bib_record_property brp
+    ON brp.bib_record_id = bri.bib_record_id
+"""
+
+# convert ITEM_QUERY rows to the values saved in the store
+def store_values(rows):
+    return [
+        row[:9]
+        # store timestamps in UTC so they sort correctly as text
+        + (row[9].astimezone(timezone.utc).isoformat(), row[10].isoformat())
+        for row in rows
+    ]
+
+# fetch items created at or after the watermark and merge them into the store
+# >= rather than > so items sharing the watermark's timestamp are not missed, the primary key removes repeats
+def fetch_new_items(store, location):
+    row = store.execute(
+        "SELECT last_created_gmt FROM watermark WHERE report = ?", (location,)
+    ).fetchone()
+    since = row[0] if row else window_start().isoformat()
+
+    # record_creation_date_gmt is compared directly, without a ::date cast, so the index can be used
+    query = ITEM_QUERY + """
+      WHERE i.record_creation_date_gmt >= %(since)s::TIMESTAMPTZ
+        AND i.location_code = %(location)s
+    """
+    rows, columns = sierra_db.run_prepared(query, {"since": since, "location": location})
+
+    new_items = store_values(rows)
+    store.executemany(
+        "INSERT OR REPLACE INTO new_item VALUES (?,?,?,?,?,?,?,?,?,?,?)", new_items
+    )
+    if new_items:
+        store.execute(
+            "INSERT OR REPLACE INTO watermark VALUES (?, ?)",
+            (location, max(item[9] for item in new_items)),
+        )
+    # drop items that have aged out of the report window
+    store.execute(
+        "DELETE FROM new_item WHERE location_code = ? AND created_date < ?",
+        (location, window_start().isoformat()),
+    )
+    store.commit()
+    return len(new_items)
+
+# read the stored items again by id and replace them with their current values
+# items that were deleted or are no longer in the location are not returned, so they drop out of the store
+def refresh_items(store, location):
+    item_ids = [
+        row[0]
+        for row in store.execute(
+            "SELECT DISTINCT item_id FROM new_item WHERE location_code = ?", (location,)
+        )
+    ]
+    if not item_ids:
+        return 0
+
+    query = ITEM_QUERY + """
+      WHERE i.id = ANY(%(items)s::BIGINT[])
+        AND i.location_code = %(location)s
+    """
+    rows, columns = sierra_db.run_prepared(query, {"items": item_ids, "location": location})
+
+    store.execute("DELETE FROM new_item WHERE location_code = ?", (location,))
+    store.executemany(
+        "INSERT OR REPLACE INTO new_item VALUES (?,?,?,?,?,?,?,?,?,?,?)", store_values(rows)
+    )
+    store.commit()
+    return len(rows)
+
+# look up series, open orders and holds for the bibs and items still in the report window
+def fetch_bib_counts(bib_ids, item_ids):
+    query = """
+      SELECT
+        b.id,
+        (SELECT string_agg(distinct pes.index_entry, ' | ')
+          FROM sierra_view.phrase_entry pes
+          WHERE pes.record_id = b.id
+            AND pes.index_tag='t'
+            AND pes.varfield_type_code='s'),
+        (SELECT count(distinct o.id)
+          FROM sierra_view.bib_record_order_record_link bro
+          JOIN sierra_view.order_record o
+            ON bro.order_record_id = o.id
+            AND o.order_status_code ='o'
+          WHERE bro.bib_record_id = b.id)
+      FROM UNNEST(%(bibs)s::BIGINT[]) AS b(id)
+    """
+    bib_rows, columns = sierra_db.run_prepared(query, {"bibs": list(bib_ids)})
+    series = {row[0]: row[1] for row in bib_rows}
+    orders = {row[0]: row[2] for row in bib_rows}
+
+    # holds can be placed on either the bib or one of its items, so count holds per record
+    query = """
+      SELECT h.record_id, count(h.id)
+      FROM sierra_view.hold h
+      WHERE h.record_id = ANY(%(records)s::BIGINT[])
+      GROUP BY h.record_id
+    """
+    hold_rows, columns = sierra_db.run_prepared(
+        query, {"records": list(bib_ids) + list(item_ids)}
+    )
+    holds = {row[0]: row[1] for row in hold_rows}
+    return series, orders, holds
+
+# build the rolling report from the store, in the same layout as the weekly new query
+def build_report(store, location):
+    items = store.execute(
+        """
+        SELECT item_id, call_number, bib_record_id, bib_record_num, location_code,
+          author, title, barcode, item_status_code
+        FROM new_item
+        WHERE location_code = ?""",
+        (location,),
+    ).fetchall()
+    series, orders, holds = fetch_bib_counts(
+        {item[2] for item in items}, {item[0] for item in items}
+    )
+
+    # group items the same way as the weekly new query's GROUP BY
+    groups = {}
+    for item in items:
+        item_id, call_number, bib_id, bib_num, location_code, author, title, barcode, status = item
+        key = (bib_num, location_code, call_number, author, title)
+        group = groups.setdefault(
+            key, {"bib_id": bib_id, "items": set(), "barcodes": set(), "counted": set()}
+        )
+        group["items"].add(item_id)
+        if barcode:
+            group["barcodes"].add(barcode)
+        if status not in EXCLUDED_STATUSES:
+            group["counted"].add(item_id)
+
+    report = []
+    for key, group in groups.items():
+        hold_count = holds.get(group["bib_id"], 0) + sum(
+            holds.get(item_id, 0) for item_id in group["items"]
+        )
+        report.append(
+            key
+            + (
+                " ".join(sorted(group["barcodes"])) or None,
+                series.get(group["bib_id"]),
+                len(group["counted"]),
+                orders.get(group["bib_id"], 0),
+                hold_count,
+            )
+        )
+    # ORDER BY i.location_code, "Call#", brp.best_author, brp.best_title, with nulls last
+    report.sort(
+        key=lambda row: tuple((value is None, value or "") for value in row[1:5])
+    )
+    return report
+
+#takes results of a sql query and a list of the results column headers and write them to a .csv file
+def write_csv(query_results, headers):
+
+    csvfile = report_artifacts.new_artifact()
+
+    #write all rows from query results to the artifact as utf-8 to match Sierra characters
+    with report_artifacts.text_writer(csvfile) as tempFile:
+        myFile = csv.writer(tempFile, delimiter=',')
+        #write header row then write full query results
+        myFile.writerow(headers)
+        myFile.writerows(query_results)
+
+    return csvfile
+
+#Send an email with an attachment passed to the function, filename is the name it is attached as
+def send_email(attachment, filename):
+    # read config file with Sierra login credentials
+    config = settings.load()
+
+    # These are variables for the email that will be sent.
+    # Make sure to use your own library's email server (emailhost)
+    emailhost = config["email"]["host"]
+    # user and pw was not in the original script, necessary for Minuteman's Gmail accounts
+    emailuser = config["email"]["user"]
+    emailpass = config["email"]["pw"]
+    emailport = "25"
+    emailsubject = "Weekly New Report"
+    emailmessage = """***This is an automated email***
+
+
+    The weekly new report has been attached. Please take a look and let the Technology Librarian know if there are any questions about it."""
+
+    # Enter your own email information
+    emailfrom = "jgoldstein@minlib.net"
+    emailto = ["jgoldstein@minlib.net"]
+
+    # Creating the email message
+    msg = MIMEMultipart()
+    msg["From"] = emailfrom
+    if type(emailto) is list:
+        msg["To"] = ", ".join(emailto)
+    else:
+        msg["To"] = emailto
+    msg["Date"] = formatdate(localtime=True)
+    msg["Subject"] = emailsubject
+    msg.attach(MIMEText(emailmessage))
+    # attach the report straight from memory, zipped if it is large
+    msg.attach(report_artifacts.attachment_part(attachment, filename))
+
+    # Sending the email message
+    smtp = smtplib.SMTP(emailhost, emailport)
+    # for Gmail connection used within Minuteman
+    smtp.ehlo()
+    smtp.starttls()
+    smtp.login(emailuser, emailpass)
+    smtp.sendmail(emailfrom, emailto, msg.as_string())
+    smtp.quit()
+
+
+def main(location):
+    headers = [
+        "Bib Record Num", "location_code", "Call#", "Author", "Title", "Barcode",
+        "Series Info", "Item Count", "Order Count", "Hold Count",
+    ]
+
+    store = open_store()
+    # bring the items fetched on earlier runs up to date before adding the new ones
+    refresh_items(store, location)
+    fetch_new_items(store, location)
+    query_results = build_report(store, location)
+    store.close()
+
+    local_file = write_csv(query_results, headers)
+    send_email(local_file, "WeeklyNewItem.csv")
+
+    #close the artifact, discarding any temporary file behind it
+    local_file.close()
+
+#open the pooled Sierra connection once, then reuse it for each location
+sierra_db.warm_up()
+
+#call main function, passing different item locations that will feed into sql query
+#only items created since the previous run are fetched, so this can be scheduled daily
+main('adfic')
+main('jfic')
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+"""Create and email a list of new items for several locations from a single query
+
+Author: Jeremy Goldstein
+Modification to script originally written by Gem Stone-Logan
+Contact Info: jgoldstein@minlib.net
+
+Rather than running the weekly new query once per location, the query is run once
+for every location with location_code = ANY(...), the results are split up by location
+and each location's spreadsheet is built and emailed in parallel.
+"""
+
+import report_artifacts
+import result_cache
+import xlsxwriter
+import settings
+import smtplib
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+#take a set of results from a sql query and write them to an Excel file, returning the file
+#query_results can be any iterable of rows, constant_memory flushes each row to disk as it is written
+def write_excel(query_results, constant_memory=False):
+    # Excel file is built in memory, spilling to a temporary file if it grows large
+    excel_file = report_artifacts.new_artifact()
+
+    # Creating the Excel file for staff
+    workbook = xlsxwriter.Workbook(excel_file, {"constant_memory": constant_memory})
+    worksheet = workbook.add_worksheet()
+
+    # Formatting our Excel worksheet
+    worksheet.set_landscape()
+    worksheet.hide_gridlines(0)
+
+    # Formatting Cells
+    eformat = workbook.add_format({"text_wrap": True, "valign": "top"})
+    eformatlabel = workbook.add_format(
+        {"text_wrap": True, "valign": "top", "bold": True}
+    )
+
+    # Setting the column widths, along with the format for every cell in the column
+    worksheet.set_column("A:A", 10.29, eformat)
+    worksheet.set_column("B:B", 6.29, eformat)
+    worksheet.set_column("C:C", 12.71, eformat)
+    worksheet.set_column("D:D", 16.57, eformat)
+    worksheet.set_column("E:E", 24.71, eformat)
+    worksheet.set_column("F:F", 11.14, eformat)
+    worksheet.set_column("G:G", 18.47, eformat)
+    worksheet.set_column("H:J", 4.5, eformat)
+
+    # Inserting a header
+    worksheet.set_header("&CWeekly New List")
+
+    # Adding column labels
+    worksheet.write_row(
+        0,
+        0,
+        [
+            "Bib Record#", "Location", "Call#", "Author", "Title",
+            "Barcode", "Series", "Item Count", "Order Count", "Hold Count",
+        ],
+        eformatlabel,
+    )
+
+    # Writing the report for staff to the Excel worksheet a whole row at a time
+    # cells pick up eformat from their column rather than being formatted one by one
+    for rownum, row in enumerate(query_results, start=1):
+        worksheet.write_row(rownum, 0, row)
+
+    workbook.close()
+    return excel_file
+
+#Send an email with an attachment passed to the function, filename is the name it is attached as
+def send_email(attachment, filename, location):
+    # read config file with Sierra login credentials
+    config = settings.load()
+
+    # These are variables for the email that will be sent.
+    # Make sure to use your own library's email server (emailhost)
+    emailhost = config["email"]["host"]
+    # user and pw was not in the original script, necessary for Minuteman's Gmail accounts
+    emailuser = config["email"]["user"]
+    emailpass = config["email"]["pw"]
+    emailport = "25"
+    emailsubject = "Weekly New Report - " + location
+    emailmessage = """***This is an automated email***
+
+
+    The weekly new report has been attached. Please take a look and let the Technology Librarian know if there are any questions about it."""
+
+    # Enter your own email information
+    emailfrom = "jgoldstein@minlib.net"
+    emailto = ["jgoldstein@minlib.net"]
+
+    # Creating the email message
+    msg = MIMEMultipart()
+    msg["From"] = emailfrom
+    if type(emailto) is list:
+        msg["To"] = ", ".join(emailto)
+    else:
+        msg["To"] = emailto
+    msg["Date"] = formatdate(localtime=True)
+    msg["Subject"] = emailsubject
+    msg.attach(MIMEText(emailmessage))
+    # attach the report straight from memory, zipped if it is large
+    msg.attach(report_artifacts.attachment_part(attachment, filename))
+
+    # Sending the email message
+    smtp = smtplib.SMTP(emailhost, emailport)
+    # for Gmail connection used within Minuteman
+    smtp.ehlo()
+    smtp.starttls()
+    smtp.login(emailuser, emailpass)
+    smtp.sendmail(emailfrom, emailto, msg.as_string())
+    smtp.quit()
+
+#split query results into a dictionary of rows keyed by location, column 2 of the query
+#every requested location gets an entry so that locations with no new items still get a report
+def partition_by_location(query_results, locations):
+    partitions = {location: [] for location in locations}
+    for row in query_results:
+        partitions[row[1]].append(row)
+    return partitions
+
+#build and email the report for a single location, then close its artifact
+def deliver_location(location, location_results):
+    local_file = write_excel(location_results)
+    send_email(local_file, "WeeklyNewItem_" + location + ".xlsx", location)
+    local_file.close()
+
+#main function takes a list of item locations, which are all retrieved by a single sql query
+#resend=True rebuilds the reports from the locally saved results instead of querying Sierra
+def main(locations, max_workers=4, resend=False):
+    query = """
+      /* Weekly New Report
+      The report will retrieve all items, not in the specifically excluded statuses
+      ('m','n','z','t','s','$','d','8','w','y'), that were created in the last 10 days.
+      It will also include a count of items per bib, count of orders with a status of "o",
+      and a count of bib-level holds.
+       */
+
+      SELECT
+        distinct 'b'|| rmb.record_num || 'a' AS "Bib Record Num",
+        i.location_code,
+        CASE
+          WHEN pei.index_entry IS NULL THEN UPPER(peb.index_entry)
+          ELSE UPPER(pei.index_entry)
+        END AS "Call#",
+        brp.best_author AS "Author",
+        brp.best_title AS "Title",
+        string_agg(distinct i.barcode, ' ') AS "Barcode",
+        string_agg(distinct pes.index_entry, ' | ') AS "Series Info",
+        count(distinct ic.id) AS "Item Count",
+        count(distinct o.id) AS "Order Count",
+        count(distinct h.id) AS "Hold Count"
+      FROM sierra_view.item_view i
+      JOIN sierra_view.bib_record_item_record_link bri
+        ON i.id = bri.item_record_id
+      JOIN sierra_view.record_metadata rmb
+        ON bri.bib_record_id = rmb.id
+        AND rmb.record_type_code='b'
+      JOIN sierra_view.phrase_entry peb
+        ON i.id = peb.record_id
+        AND peb.index_tag='c'
+      JOIN sierra_view.bib_record_property brp
+        ON brp.bib_record_id = bri.bib_record_id
+      LEFT JOIN sierra_view.phrase_entry pei
+        ON pei.record_id=bri.item_record_id
+        AND pei.index_tag='c'
+      LEFT JOIN sierra_view.phrase_entry pes
+        ON pes.record_id=bri.bib_record_id
+        AND pes.index_tag='t'
+        AND pes.varfield_type_code='s'
+      LEFT JOIN sierra_view.item_record ic
+        ON ic.id=i.id
+        AND ic.item_status_code not in ('m','n','z','t','s','$','d','8','w','y')
+      LEFT JOIN sierra_view.hold h
+        ON (bri.bib_record_id = h.record_id OR i.id = h.record_id)
+      LEFT JOIN sierra_view.bib_record_order_record_link bro
+        ON bri.bib_record_id = bro.bib_record_id
+      LEFT JOIN sierra_view.order_record o
+        ON bro.order_record_id = o.id
+        AND o.order_status_code ='o'
+
+      WHERE i.record_creation_date_gmt::date>=NOW()::DATE-EXTRACT(DOW FROM NOW())::INTEGER-10
+        AND i.location_code = ANY(%(locations)s)
+      GROUP BY rmb.record_num, i.location_code, "Call#", brp.best_author, brp.best_title
+      ORDER BY i.location_code, "Call#", brp.best_author, brp.best_title
+    """
+
+    # one pass over item_view, holds and orders for all of the locations, saved to the local cache
+    query_results, headers = result_cache.cached_query(
+        query,
+        {"locations": list(locations)},
+        window=result_cache.week_window(),
+        refresh=not resend,
+    )
+    partitions = partition_by_location(query_results, locations)
+
+    # build and email each location's spreadsheet in parallel
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(deliver_location, location, location_results)
+            for location, location_results in partitions.items()
+        ]
+        # re-raise any error from the workers
+        for future in futures:
+            future.result()
+
+#run with --resend to email the reports again from the saved results, without querying Sierra
+resend = "--resend" in sys.argv
+
+#call main function, passing every item location that will feed into the sql query
+main(['adfic', 'jfic'], resend=resend)